@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import glob
+import html
+import os
+import random
+import re
+import sys
+import threading
+
+from aiohttp import web
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'extract-async'))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import selector_engine  # noqa: E402
+from common import config  # noqa: E402
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+article_file = re.compile(r'^article_(\d+)\.html$')
+
+
+def _read(path):
+    with open(path, mode='r', encoding='utf-8') as file:
+        return file.read()
+
+
+def _site_pages(news_site_uid, site_dir):
+    # record_fixtures.py saves the article of sorted(links)[i] as article_i,
+    # so the homepage links are pointed at the recorded files
+    home = _read(os.path.join(site_dir, 'home.html'))
+    queries = config()['news_sites'][news_site_uid]['queries']
+    links = sorted(selector_engine.build_engine(queries).article_links(home))
+
+    pages = {}
+    for path in glob.glob(os.path.join(site_dir, 'article_*.html')):
+        match = article_file.match(os.path.basename(path))
+        pages['article_{:04d}'.format(int(match.group(1)))] = _read(path)
+
+    for index, link in enumerate(links):
+        page = 'article_{:04d}'.format(index)
+        if page not in pages:
+            page = 'missing_{:04d}'.format(index)
+        for href in set([link, html.escape(link)]):
+            home = home.replace('href="{}"'.format(href), 'href="{}"'.format(page))
+            home = home.replace("href='{}'".format(href), "href='{}'".format(page))
+    pages[''] = home
+    return pages
+
+
+def load_sites(fixtures_dir=FIXTURES_DIR):
+    sites = {}
+    for news_site_uid in sorted(os.listdir(fixtures_dir)):
+        site_dir = os.path.join(fixtures_dir, news_site_uid)
+        if news_site_uid in config()['news_sites'] and os.path.isdir(site_dir):
+            sites[news_site_uid] = _site_pages(news_site_uid, site_dir)
+    return sites
+
+
+# Serves the recorded pages of every site under /<news_site_uid>/, each
+# response delayed around latency seconds and a share of them (error_rate)
+# answered with a 503
+def make_app(sites, latency=0, error_rate=0):
+    stats = {'requests': 0, 'errors': 0}
+
+    async def page(request):
+        stats['requests'] += 1
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if error_rate and random.random() < error_rate:
+            stats['errors'] += 1
+            return web.Response(status=503)
+
+        pages = sites.get(request.match_info['news_site_uid'])
+        text = pages.get(request.match_info.get('page', '')) if pages else None
+        if text is None:
+            return web.Response(status=404)
+        return web.Response(text=text, content_type='text/html')
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_get('/{news_site_uid}', page)
+    app.router.add_get('/{news_site_uid}/', page)
+    app.router.add_get('/{news_site_uid}/{page}', page)
+    return app
+
+
+def site_urls(sites, port, host='127.0.0.1'):
+    return {news_site_uid: 'http://{}:{}/{}'.format(host, port, news_site_uid)
+            for news_site_uid in sites}
+
+
+def start(sites, port=0, latency=0, error_rate=0, host='127.0.0.1'):
+    # Runs the server on its own event loop in a daemon thread and returns
+    # the port it listens on
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(sites, latency, error_rate), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return site._server.sockets[0].getsockname()[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p',
+                        '--port',
+                        help='Port the server listens on',
+                        type=int,
+                        default=8080)
+    parser.add_argument('-d',
+                        '--fixtures-dir',
+                        help='Folder with one sub folder of html per news site',
+                        default=FIXTURES_DIR)
+    parser.add_argument('--latency',
+                        help='Average seconds before every response',
+                        type=float,
+                        default=0)
+    parser.add_argument('--error-rate',
+                        help='Share of requests answered with a 503',
+                        type=float,
+                        default=0)
+    args = parser.parse_args()
+
+    sites = load_sites(args.fixtures_dir)
+    for news_site_uid, url in site_urls(sites, args.port).items():
+        logger.info('Serving {} at {}'.format(news_site_uid, url))
+    web.run_app(make_app(sites, args.latency, args.error_rate), port=args.port)
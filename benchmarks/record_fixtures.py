@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import os
+import sys
+
+import aiohttp
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'extract-async'))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import news_page_objects as news  # noqa: E402
+import selector_engine  # noqa: E402
+from common import config  # noqa: E402
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _save(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', encoding='utf-8') as file:
+        file.write(text)
+
+
+async def _get(session, url):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.text()
+
+
+async def _record_site(news_site_uid, session, max_articles):
+    site = config()['news_sites'][news_site_uid]
+    site_dir = os.path.join(FIXTURES_DIR, news_site_uid)
+    try:
+        text = await _get(session, site['url'])
+    except Exception as e:
+        logger.error('ERROR recording {}: {}'.format(news_site_uid, e))
+        return 0
+    _save(os.path.join(site_dir, 'home.html'), text)
+
+    links = selector_engine.build_engine(site['queries']).article_links(text)
+    recorded = 0
+    for index, link in enumerate(sorted(links)[:max_articles]):
+        try:
+            text = await _get(session, news._build_link(site['url'], link))
+        except Exception as e:
+            logger.warning('ERROR recording {}: {}'.format(link, e))
+            continue
+        _save(os.path.join(site_dir, 'article_{:04d}.html'.format(index)), text)
+        recorded += 1
+    logger.info('Recorded {} articles for {}'.format(recorded, news_site_uid))
+    return recorded
+
+
+async def _record(news_sites_selected, max_articles):
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[_record_site(news_site_uid, session, max_articles)
+                               for news_site_uid in news_sites_selected])
+
+
+if __name__ == '__main__':
+    news_site_choices = list(config()['news_sites'].keys())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l',
+                        '--names-list',
+                        nargs='+',
+                        help='The news sites to record',
+                        choices=news_site_choices,
+                        default=news_site_choices,)
+    parser.add_argument('-n',
+                        '--max-articles',
+                        help='Articles recorded per site',
+                        type=int,
+                        default=20)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_record(args.names_list, args.max_articles))
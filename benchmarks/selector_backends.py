@@ -0,0 +1,90 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'extract-async'))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import selector_engine  # noqa: E402
+from common import config  # noqa: E402
+
+
+def _read(path):
+    with open(path, mode='r', encoding='utf-8') as file:
+        return file.read()
+
+
+def _load_fixtures(fixtures_dir):
+    fixtures = {}
+    for news_site_uid in sorted(os.listdir(fixtures_dir)):
+        site_dir = os.path.join(fixtures_dir, news_site_uid)
+        if news_site_uid not in config()['news_sites'] or not os.path.isdir(site_dir):
+            continue
+        fixtures[news_site_uid] = {
+            'home': _read(os.path.join(site_dir, 'home.html')),
+            'articles': [_read(path) for path in
+                         sorted(glob.glob(os.path.join(site_dir, 'article_*.html')))],
+        }
+    return fixtures
+
+
+def _bench_backend(backend, fixtures, repeat):
+    pages = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for news_site_uid, site_fixtures in fixtures.items():
+            queries = config()['news_sites'][news_site_uid]['queries']
+            site_engine = selector_engine.build_engine(queries, backend)
+            site_engine.article_links(site_fixtures['home'])
+            for text in site_fixtures['articles']:
+                site_engine.article_fields(text)
+            pages += 1 + len(site_fixtures['articles'])
+    elapsed = time.perf_counter() - start
+    return {
+        'backend': backend,
+        'pages': pages,
+        'seconds': round(elapsed, 4),
+        'pages_per_second': round(pages / elapsed, 1) if elapsed else None,
+    }
+
+
+def _main(backends, fixtures_dir, repeat):
+    fixtures = _load_fixtures(fixtures_dir)
+    if not fixtures:
+        sys.exit('No fixtures found in {}, record them with record_fixtures.py'.format(
+            fixtures_dir))
+
+    results = []
+    for backend in backends:
+        try:
+            results.append(_bench_backend(backend, fixtures, repeat))
+        except ImportError as e:
+            results.append({'backend': backend, 'error': str(e)})
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b',
+                        '--backends',
+                        nargs='+',
+                        help='The parser backends to compare',
+                        choices=selector_engine.BACKENDS,
+                        default=list(selector_engine.BACKENDS))
+    parser.add_argument('-d',
+                        '--fixtures-dir',
+                        help='Folder with one sub folder of html per news site',
+                        default=FIXTURES_DIR)
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Times every fixture is parsed',
+                        type=int,
+                        default=5)
+    args = parser.parse_args()
+    _main(args.backends, args.fixtures_dir, args.repeat)
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+
+# Every CLI with the folder it runs from, timed with --help so nothing but
+# the imports and the argument parser run
+COMMANDS = {
+    'pipeline': ('.', ['pipeline.py', '--help']),
+    'daemon': ('.', ['daemon.py', '--help']),
+    'extract-async': ('extract-async', ['main.py', '--help']),
+    'transform': ('transform', ['news_papper_recipe.py', '--help']),
+    'load': ('load', ['main.py', '--help']),
+    'queries': ('load', ['queries.py', '--help']),
+    'search': ('load', ['search.py', '--help']),
+    'dataset': ('load', ['dataset.py', '--help']),
+}
+
+
+def _run(command, extra_options=()):
+    folder, args = COMMANDS[command]
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + list(extra_options) + args,
+                            cwd=os.path.join(ROOT_DIR, folder),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError('{} failed: {}'.format(command, result.stderr.strip()[-500:]))
+    return elapsed, result.stderr
+
+
+def _slowest_imports(stderr, count):
+    # python -X importtime lines: "import time: self [us] | cumulative | name"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return [{'module': name, 'seconds': round(cumulative / 1e6, 4)}
+            for cumulative, name in sorted(imports, reverse=True)[:count]]
+
+
+def _bench_command(command, repeat, top_imports):
+    try:
+        timings = [_run(command)[0] for _ in range(repeat)]
+        result = {
+            'command': command,
+            'median_seconds': round(statistics.median(timings), 4),
+            'min_seconds': round(min(timings), 4),
+        }
+        if top_imports:
+            _, stderr = _run(command, ['-X', 'importtime'])
+            result['slowest_imports'] = _slowest_imports(stderr, top_imports)
+    except RuntimeError as e:
+        result = {'command': command, 'error': str(e)}
+    return result
+
+
+def _main(commands, repeat, top_imports, output):
+    results = [_bench_command(command, repeat, top_imports) for command in commands]
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, mode='w') as file:
+            file.write(text)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c',
+                        '--commands',
+                        nargs='+',
+                        help='The CLIs to time',
+                        choices=list(COMMANDS.keys()),
+                        default=list(COMMANDS.keys()))
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Times every CLI is started',
+                        type=int,
+                        default=5)
+    parser.add_argument('-t',
+                        '--top-imports',
+                        help='Also list this many of the slowest top level imports',
+                        type=int,
+                        default=0)
+    parser.add_argument('-o',
+                        '--output',
+                        help='Also write the results to this json file',
+                        default=None)
+    args = parser.parse_args()
+    _main(args.commands, args.repeat, args.top_imports, args.output)
@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BASE_DIR, '..')
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures')
+# The modules every stage uses
+sys.path.insert(0, os.path.join(ROOT_DIR, 'shared'))
+
+import logging
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Every stage runs in its own process: the extractors import sibling
+# modules with the same names, and the peak memory is the stage's own
+STAGES = ('fetch', 'parse', 'extract', 'extract-async', 'transform', 'tokenize', 'load',
+          'pipeline')
+
+
+def _peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _use_mock_urls(config, site_urls):
+    config()['news_sites'] = {news_site_uid: dict(config()['news_sites'][news_site_uid],
+                                                  url=url)
+                              for news_site_uid, url in site_urls.items()}
+    config()['response_cache'] = {'mode': 'off'}
+
+
+def _fixture_pages(fixtures_dir):
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'extract-async'))
+    from selector_backends import _load_fixtures
+    return _load_fixtures(fixtures_dir)
+
+
+def _bench_fetch(context):
+    import aiohttp
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'extract-async'))
+    from scheduler import scheduler_settings
+
+    async def fetch_all(urls):
+        semaphore = asyncio.Semaphore(scheduler_settings()['max_concurrency'])
+
+        async def fetch(session, url):
+            async with semaphore:
+                async with session.get(url) as response:
+                    await response.read()
+                    return response.status < 400
+
+        async with aiohttp.ClientSession() as session:
+            return sum(await asyncio.gather(*[fetch(session, url) for url in urls]))
+
+    return lambda: asyncio.get_event_loop().run_until_complete(fetch_all(context['page_urls']))
+
+
+def _bench_parse(context):
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'extract-async'))
+    import selector_engine
+    from common import config
+    fixtures = _fixture_pages(context['fixtures_dir'])
+    backend = (config().get('parser') or {}).get('backend') or 'html.parser'
+
+    def parse():
+        pages = 0
+        for _ in range(context['repeat']):
+            for news_site_uid, site_fixtures in fixtures.items():
+                site_engine = selector_engine.build_engine(
+                    config()['news_sites'][news_site_uid]['queries'], backend)
+                site_engine.article_links(site_fixtures['home'])
+                for text in site_fixtures['articles']:
+                    site_engine.article_fields(text)
+                pages += 1 + len(site_fixtures['articles'])
+        return pages
+
+    return parse
+
+
+def _bench_extract(context):
+    # The sync extractor writes its files to the working directory
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'extract'))
+    import main
+    from common import config
+    _use_mock_urls(config, context['site_urls'])
+    output_dir = tempfile.mkdtemp()
+    os.chdir(output_dir)
+
+    def extract():
+        for news_site_uid in context['site_urls']:
+            main._news_scraper(news_site_uid, use_index=False, output_format='csv')
+        rows = 0
+        for path in glob.glob(os.path.join(output_dir, '*.csv')):
+            with open(path, mode='r') as file:
+                rows += sum(1 for _ in file) - 1
+        return rows
+
+    return extract
+
+
+def _bench_extract_async(context):
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'extract-async'))
+    import main
+    from common import config
+    _use_mock_urls(config, context['site_urls'])
+
+    async def scrape():
+        articles = 0
+        async for _ in main._scrape_articles(list(context['site_urls'])):
+            articles += 1
+        return articles
+
+    return lambda: asyncio.get_event_loop().run_until_complete(scrape())
+
+
+def _articles_frame(pipeline, context):
+    # Parsed fixtures, repeated with distinct urls and titles so none of
+    # them is dropped as a duplicate
+    import selector_engine
+    from article_record import ArticleRecord
+    fixtures = _fixture_pages(context['fixtures_dir'])
+    frames = {}
+    for news_site_uid, site_fixtures in fixtures.items():
+        site_engine = selector_engine.build_engine(
+            pipeline.extract.config()['news_sites'][news_site_uid]['queries'])
+        fields = [site_engine.article_fields(text) for text in site_fixtures['articles']]
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        records = [ArticleRecord(str(article['body']),
+                                 now,
+                                 '{} {}'.format(article['title'], copy),
+                                 'http://{}.example/{}/{}'.format(news_site_uid, copy, position))
+                   for copy in range(context['repeat'])
+                   for position, article in enumerate(fields)]
+        frames[news_site_uid] = pipeline._records_to_frame(records)
+    return frames
+
+
+def _import_pipeline():
+    os.environ['NEWSPAPER_DB'] = os.path.join(tempfile.mkdtemp(), 'newspaper.db')
+    sys.path.insert(0, ROOT_DIR)
+    import pipeline
+    return pipeline
+
+
+def _bench_transform(context):
+    pipeline = _import_pipeline()
+    frames = _articles_frame(pipeline, context)
+
+    def transform():
+        return sum(len(pipeline.transform.transform(df.copy(), news_site_uid,
+                                                    context['engine']))
+                   for news_site_uid, df in frames.items())
+
+    return transform
+
+
+def _bench_tokenize(context):
+    pipeline = _import_pipeline()
+    frames = _articles_frame(pipeline, context)
+    tokenize_columns = pipeline.transform.ENGINES[context['engine']]['tokenize_columns']
+    stop_words = pipeline.transform._stop_words()
+
+    def tokenize():
+        rows = 0
+        for df in frames.values():
+            rows += len(tokenize_columns(df.copy(), ['title_csv', 'body_csv'], stop_words))
+        return rows
+
+    return tokenize
+
+
+def _bench_load(context):
+    pipeline = _import_pipeline()
+    frames = _articles_frame(pipeline, context)
+    clean = [pipeline.transform.transform(df, news_site_uid, context['engine']).reset_index()
+             for news_site_uid, df in frames.items()]
+    pipeline.load.ensure_schema()
+
+    return lambda: sum(pipeline.load._load_articles(df) for df in clean)
+
+
+def _bench_pipeline(context):
+    pipeline = _import_pipeline()
+    _use_mock_urls(pipeline.extract.config, context['site_urls'])
+
+    def run():
+        loaded = asyncio.get_event_loop().run_until_complete(pipeline.run(
+            list(context['site_urls']), use_index=False, engine=context['engine'],
+            use_memo=False))
+        return sum(loaded.values())
+
+    return run
+
+
+BENCHMARKS = {
+    'fetch': _bench_fetch,
+    'parse': _bench_parse,
+    'extract': _bench_extract,
+    'extract-async': _bench_extract_async,
+    'transform': _bench_transform,
+    'tokenize': _bench_tokenize,
+    'load': _bench_load,
+    'pipeline': _bench_pipeline,
+}
+
+
+def _run_stage(stage, context):
+    bench = BENCHMARKS[stage](context)
+    memory_before = _peak_memory_mb()
+    start = time.perf_counter()
+    items = bench()
+    elapsed = time.perf_counter() - start
+    return {
+        'stage': stage,
+        'items': items,
+        'seconds': round(elapsed, 4),
+        'items_per_second': round(items / elapsed, 1) if elapsed else None,
+        'peak_memory_mb': round(_peak_memory_mb(), 1),
+        'memory_growth_mb': round(_peak_memory_mb() - memory_before, 1),
+    }
+
+
+def _run_in_process(stage, context_path):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__),
+                             '--run-stage', stage, '--context', context_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode:
+        logger.error('ERROR running {}: {}'.format(stage, result.stderr.strip()[-2000:]))
+        return {'stage': stage, 'error': result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _main(stages, fixtures_dir, latency, error_rate, repeat, engine, output):
+    sys.path.insert(0, BASE_DIR)
+    import mock_server
+
+    sites = mock_server.load_sites(fixtures_dir)
+    if not sites:
+        sys.exit('No fixtures found in {}, record them with record_fixtures.py'.format(
+            fixtures_dir))
+    port = mock_server.start(sites, latency=latency, error_rate=error_rate)
+    site_urls = mock_server.site_urls(sites, port)
+
+    context = {
+        'fixtures_dir': fixtures_dir,
+        'site_urls': site_urls,
+        'page_urls': ['{}/{}'.format(site_urls[news_site_uid], page)
+                      for news_site_uid, pages in sites.items() for page in pages],
+        'repeat': repeat,
+        'engine': engine,
+    }
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as file:
+        json.dump(context, file)
+
+    results = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sites': list(sites),
+        'latency': latency,
+        'error_rate': error_rate,
+        'repeat': repeat,
+        'engine': engine,
+        'stages': [_run_in_process(stage, file.name) for stage in stages],
+    }
+    os.remove(file.name)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, mode='w') as file:
+            file.write(text)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s',
+                        '--stages',
+                        nargs='+',
+                        help='The stages to measure',
+                        choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('-d',
+                        '--fixtures-dir',
+                        help='Folder with one sub folder of html per news site',
+                        default=FIXTURES_DIR)
+    parser.add_argument('--latency',
+                        help='Average seconds the mock server waits before every response',
+                        type=float,
+                        default=0)
+    parser.add_argument('--error-rate',
+                        help='Share of mock server requests answered with a 503',
+                        type=float,
+                        default=0)
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Times the fixtures are repeated by the offline stages',
+                        type=int,
+                        default=10)
+    parser.add_argument('-e',
+                        '--engine',
+                        help='The implementation of the cleaning steps',
+                        choices=['default', 'fast'],
+                        default='fast')
+    parser.add_argument('-o',
+                        '--output',
+                        help='Also write the results to this json file',
+                        default=None)
+    parser.add_argument('--run-stage',
+                        help=argparse.SUPPRESS,
+                        choices=STAGES)
+    parser.add_argument('--context',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        with open(args.context, mode='r') as file:
+            stage_context = json.load(file)
+        print(json.dumps(_run_stage(args.run_stage, stage_context)))
+    else:
+        _main(args.stages, args.fixtures_dir, args.latency, args.error_rate, args.repeat,
+              args.engine, args.output)
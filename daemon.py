@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import signal
+import time
+
+import pipeline
+from pipeline import extract, load
+from frontier import close_seen_urls, save_seen_urls
+
+import logging
+logger = logging.getLogger(__name__)
+
+_DEFAULT_SETTINGS = {
+    'interval': 900,
+    'min_interval': 60,
+    'max_interval': 3600,
+    'speed_up': 0.5,
+    'slow_down': 1.5,
+}
+
+
+def daemon_settings():
+    settings = dict(_DEFAULT_SETTINGS)
+    settings.update(extract.config().get('daemon') or {})
+    return settings
+
+
+# When every site is crawled next. A site whose homepage lists new articles
+# is re-crawled sooner, one whose homepage didn't change (or failed) later,
+# always between min_interval and max_interval seconds.
+class RecrawlSchedule:
+    def __init__(self, news_sites_selected, settings=None):
+        self._settings = settings or daemon_settings()
+        now = time.monotonic()
+        self._sites = {
+            news_site_uid: {
+                'interval': self._initial_interval(news_site_uid),
+                'due': now,
+                'links': None,
+            } for news_site_uid in news_sites_selected}
+
+    def _initial_interval(self, news_site_uid):
+        site = extract.config()['news_sites'][news_site_uid]
+        return site.get('recrawl_interval') or self._settings['interval']
+
+    def wait_time(self, news_site_uid):
+        return max(0, self._sites[news_site_uid]['due'] - time.monotonic())
+
+    def update(self, news_site_uid, links):
+        site = self._sites[news_site_uid]
+        new_links = set(links or []) - (site['links'] or set())
+        if site['links'] is None and links:
+            factor = 1
+        elif new_links:
+            factor = self._settings['speed_up']
+        else:
+            factor = self._settings['slow_down']
+
+        site['interval'] = min(self._settings['max_interval'],
+                               max(self._settings['min_interval'], site['interval'] * factor))
+        site['due'] = time.monotonic() + site['interval']
+        if links:
+            site['links'] = set(links)
+        logger.info('{} new links for {}, next crawl in {:.0f}s'.format(
+            len(new_links), news_site_uid, site['interval']))
+
+
+async def _crawl_round(news_site_uid, session, scheduler, batch_size, options, stop):
+    homepages = {}
+    loaded = await pipeline._process_articles(
+        extract._scrape_round([news_site_uid], session, scheduler, options['index'],
+                              homepages, stop),
+        [news_site_uid], batch_size, options)
+    logger.info('Loaded {} articles for {}'.format(loaded[news_site_uid], news_site_uid))
+    return homepages.get(news_site_uid)
+
+
+async def _crawl_site(news_site_uid, session, scheduler, schedule, batch_size, options,
+                      stop, rounds=None):
+    # Every site is crawled on its own interval, a slow crawl of one site
+    # doesn't hold back the others. Returns the crawls completed.
+    completed = 0
+    while not stop.is_set() and (rounds is None or completed < rounds):
+        try:
+            await asyncio.wait_for(stop.wait(), schedule.wait_time(news_site_uid))
+            break
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            links = await _crawl_round(news_site_uid, session, scheduler, batch_size,
+                                       options, stop)
+        except Exception as e:
+            logger.error('ERROR crawling {}: {}'.format(news_site_uid, e))
+            links = None
+        if stop.is_set():
+            break
+        schedule.update(news_site_uid, links)
+        completed += 1
+        # Saved every crawl, a daemon that dies loses one crawl of urls
+        save_seen_urls(options['index'])
+        if options['index']:
+            options['index'].commit()
+        pipeline.metrics.export()
+    return completed
+
+
+async def run(news_sites_selected, batch_size=50, csv_dir=None, use_index=True,
+              engine='fast', workers=None, near_duplicates_mode=None, similarity=0.8,
+              rounds=None, use_memo=True):
+    # rounds is the number of crawls of every site
+    pipeline._check_schema()
+    settings = extract.scheduler_settings()
+    timeout = extract.resilience.request_timeout(settings['request_timeout'])
+    options = pipeline._options(csv_dir, engine, workers, near_duplicates_mode, similarity,
+                                use_index, use_memo)
+    schedule = RecrawlSchedule(news_sites_selected)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    load.ensure_schema()
+    completed = 0
+    try:
+        # One session, connection pool and scheduler for the whole run
+        async with extract.aiohttp.ClientSession(timeout=timeout) as session:
+            scheduler = extract.FetchScheduler(settings)
+            completed = sum(await asyncio.gather(*[
+                _crawl_site(news_site_uid, session, scheduler, schedule, batch_size,
+                            options, stop, rounds)
+                for news_site_uid in news_sites_selected]))
+    finally:
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signal_number)
+        close_seen_urls(options['index'])
+        pipeline._close_options(options)
+        extract.news.shutdown_parser_executor()
+        extract.response_cache.close_cache()
+    logger.info('Daemon stopped after {} site crawls'.format(completed))
+
+
+def _main():
+    news_site_choices = list(extract.config()['news_sites'].keys())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l',
+                        '--names-list',
+                        nargs='+',
+                        help='The news sites list that you want to keep crawling',
+                        choices=news_site_choices,
+                        default=news_site_choices,)
+    parser.add_argument('-b',
+                        '--batch-size',
+                        help='Articles transformed and loaded at once',
+                        type=int,
+                        default=50)
+    parser.add_argument('-p',
+                        '--parse-workers',
+                        help='Parse pages in a pool of this many processes',
+                        type=int,
+                        default=None)
+    parser.add_argument('-e',
+                        '--engine',
+                        help='The implementation of the cleaning steps',
+                        choices=list(pipeline.transform.ENGINES.keys()),
+                        default='fast')
+    parser.add_argument('-w',
+                        '--tokenize-workers',
+                        help='Tokenize in a pool of this many processes',
+                        type=int,
+                        default=None)
+    parser.add_argument('-d',
+                        '--near-duplicates',
+                        help='Flag articles similar to earlier ones, or drop them',
+                        choices=pipeline.transform.near_duplicates_modes,
+                        default=None)
+    parser.add_argument('-s',
+                        '--similarity',
+                        help='Estimated Jaccard similarity of near duplicate bodies',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--csv-dir',
+                        help='Also write the clean CSV of each site in this folder',
+                        type=str,
+                        default=None)
+    parser.add_argument('--cache-mode',
+                        help='Cache responses on disk, or only replay the cached ones',
+                        choices=extract.response_cache.MODES,
+                        default=None)
+    parser.add_argument('--no-index',
+                        help='Fetch every article on every crawl, not only the new ones',
+                        action='store_true')
+    parser.add_argument('--dataset',
+                        help='Also append the articles to the parquet dataset (needs pyarrow)',
+                        action='store_true')
+    parser.add_argument('--no-memo',
+                        help='Tokenize every text, even the ones counted in earlier rounds',
+                        action='store_true')
+    parser.add_argument('--rounds',
+                        help='Stop after crawling every site this many times',
+                        type=int,
+                        default=None)
+    args = parser.parse_args()
+    pipeline.metrics.configure_from(extract.config().get('metrics'))
+    if args.parse_workers:
+        extract.news.use_process_pool(args.parse_workers)
+    if args.cache_mode:
+        extract.response_cache.use_cache_mode(args.cache_mode)
+    if args.dataset:
+        load.use_dataset()
+
+    logger.info('Starting daemon for {}'.format(args.names_list))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.names_list,
+                                args.batch_size,
+                                args.csv_dir,
+                                not args.no_index,
+                                args.engine,
+                                args.tokenize_workers,
+                                args.near_duplicates,
+                                args.similarity,
+                                args.rounds,
+                                not args.no_memo))
+
+
+if __name__ == '__main__':
+    _main()
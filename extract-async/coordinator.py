@@ -0,0 +1,126 @@
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import metrics  # noqa: E402
+import writers  # noqa: E402
+from common import config  # noqa: E402
+from job_queue import open_queue, queue_settings  # noqa: E402
+
+import logging  # noqa: E402
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ws")
+
+collected_articles = metrics.counter('queue_collected_articles',
+                                     'Articles collected from the queue, per site')
+
+
+def _start_workers(count, use_index=True):
+    command = [sys.executable, os.path.join(BASE_DIR, 'worker.py')]
+    if not use_index:
+        command.append('--no-index')
+    return [subprocess.Popen(command) for _ in range(count)]
+
+
+def _collect(queue, outputs, handed_over, last_id, output_format):
+    # Results leave the queue once their writer has them on disk
+    now = datetime.datetime.now().strftime('%d_%m_%Y')
+
+    def collected(records):
+        queue.collected([handed_over.pop(id(record)) for record in records])
+
+    results = queue.results(last_id)
+    for result_id, news_site_uid, record in results:
+        if news_site_uid not in outputs:
+            outputs[news_site_uid] = writers.open_writer(
+                '{}_{}'.format(news_site_uid, now), collected, output_format)
+        handed_over[id(record)] = result_id
+        try:
+            outputs[news_site_uid].write(record)
+            collected_articles.inc(news_site_uid=news_site_uid)
+        except Exception as e:
+            logger.error('ERROR writing article: {}'.format(e))
+            queue.collected([handed_over.pop(id(record))])
+    return results[-1][0] if results else last_id
+
+
+def run(news_sites_selected, workers=0, use_index=True, output_format=None,
+        report_every=30):
+    # Queues the homepage of every site, then writes the articles the
+    # workers report until no job is left. Workers started elsewhere on the
+    # same queue file take part as well.
+    settings = queue_settings()
+    queue = open_queue(settings)
+    for news_site_uid in news_sites_selected:
+        queue.add_homepage(news_site_uid, config()['news_sites'][news_site_uid]['url'])
+    logger.info('Queued {} homepages in {}'.format(len(news_sites_selected), settings['path']))
+
+    processes = _start_workers(workers, use_index)
+    outputs = {}
+    handed_over = {}
+    last_id = 0
+    reported_at = time.monotonic()
+    try:
+        while True:
+            idle = queue.is_idle()
+            collected_up_to = _collect(queue, outputs, handed_over, last_id, output_format)
+            if collected_up_to != last_id:
+                last_id = collected_up_to
+                continue
+            if idle:
+                break
+            if processes and all(process.poll() is not None for process in processes):
+                logger.warning('Every local worker stopped with jobs left in the queue')
+                break
+            if time.monotonic() - reported_at >= report_every:
+                logger.info('Queue: {}'.format(queue.counts()))
+                reported_at = time.monotonic()
+            time.sleep(settings['poll_interval'])
+    finally:
+        for output in outputs.values():
+            output.close()
+            logger.info('Wrote {} articles to {}'.format(output.rows, output.path))
+        for process in processes:
+            process.wait()
+        counts = queue.counts()
+        queue.close()
+        metrics.export()
+    logger.info('Queue: {}'.format(counts))
+    return counts
+
+
+if __name__ == '__main__':
+    news_site_choices = list(config()['news_sites'].keys())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l',
+                        '--names-list',
+                        nargs='+',
+                        help='The news sites list that you want to scrape',
+                        choices=news_site_choices,
+                        default=news_site_choices,)
+    parser.add_argument('-n',
+                        '--workers',
+                        help='Worker processes started on this machine, 0 to only '
+                             'use the ones started with worker.py',
+                        type=int,
+                        default=0)
+    parser.add_argument('-f',
+                        '--format',
+                        help='The file format articles are written in',
+                        choices=writers.FORMATS,
+                        default=None)
+    parser.add_argument('--no-index',
+                        help='Fetch every article, even the ones crawled before',
+                        action='store_true')
+    args = parser.parse_args()
+    metrics.configure_from(config().get('metrics'))
+
+    run(args.names_list, args.workers, not args.no_index, args.format)
@@ -0,0 +1,230 @@
+import contextlib
+import os
+import socket
+import sqlite3
+import time
+from urllib.parse import urlparse
+
+from article_record import FIELDS, ArticleRecord
+from common import config
+
+import logging
+logger = logging.getLogger("ws")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATES = ('pending', 'leased', 'done', 'failed')
+
+_DEFAULT_SETTINGS = {
+    'path': '../job_queue.db',
+    'lease_seconds': 120,
+    'max_attempts': 3,
+    'retry_after': 30,
+    'hosts_per_claim': 4,
+    'jobs_per_host': 20,
+    'poll_interval': 2,
+}
+
+
+def queue_settings():
+    settings = dict(_DEFAULT_SETTINGS)
+    settings.update({name: value for name, value in (config().get('job_queue') or {}).items()
+                     if value is not None})
+    return settings
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+# Homepage and article jobs shared by a coordinator and any number of worker
+# processes, on this machine or others sharing the file. A worker leases a
+# host (its shard) before leasing that host's jobs, so only one worker
+# fetches from a host at a time and its per host limits still hold. Leases
+# expire, so the jobs of a worker that died go back to the others, and a
+# failed job is retried after retry_after seconds, doubled every attempt,
+# until max_attempts. Workers report the articles they extract as results,
+# which the coordinator collects.
+class JobQueue:
+    def __init__(self, path, lease_seconds=120, max_attempts=3, retry_after=30):
+        self._path = os.path.join(BASE_DIR, path)
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._retry_after = retry_after
+        # Transactions are explicit, claims take the write lock up front.
+        # Workers call it from a thread of their own, one call at a time.
+        self._connection = sqlite3.connect(self._path, timeout=30, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT,
+                news_site_uid TEXT,
+                host TEXT,
+                url TEXT,
+                state TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                available_at REAL DEFAULT 0,
+                error TEXT,
+                UNIQUE (kind, url)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_host_state ON jobs (host, state, available_at);
+            CREATE TABLE IF NOT EXISTS shards (
+                host TEXT PRIMARY KEY,
+                worker TEXT,
+                lease_until REAL
+            );
+            -- Never reuses the id of a collected result, the coordinator
+            -- reads past the last one it handed to a writer
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER,
+                news_site_uid TEXT,
+                body_csv TEXT,
+                fetched_at_csv TEXT,
+                title_csv TEXT,
+                url_csv TEXT
+            );
+        ''')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Takes the write lock up front, so two workers never claim the same job
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+    def _add(self, kind, news_site_uid, urls):
+        # A job that finished or failed in an earlier round goes back to
+        # pending, one that is waiting or leased is left as it is
+        with self._transaction():
+            self._connection.executemany('''
+                INSERT INTO jobs (kind, news_site_uid, host, url) VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, url) DO UPDATE SET
+                    state = 'pending', attempts = 0, available_at = 0, error = NULL
+                WHERE state IN ('done', 'failed')''',
+                [(kind, news_site_uid, urlparse(url).netloc, url) for url in urls])
+
+    def add_homepage(self, news_site_uid, url):
+        self._add('homepage', news_site_uid, [url])
+
+    def add_articles(self, news_site_uid, urls):
+        self._add('article', news_site_uid, urls)
+
+    def _claimable_hosts(self, worker, now, count):
+        # Hosts with jobs ready to run whose shard is free, expired or
+        # already this worker's, the ones it holds first
+        return [host for host, in self._connection.execute('''
+            SELECT jobs.host FROM jobs LEFT JOIN shards ON shards.host = jobs.host
+            WHERE ((jobs.state = 'pending' AND jobs.available_at <= :now)
+                   OR (jobs.state = 'leased' AND jobs.lease_until < :now))
+              AND (shards.host IS NULL OR shards.lease_until < :now
+                   OR shards.worker = :worker)
+            GROUP BY jobs.host
+            ORDER BY MAX(shards.worker = :worker) DESC, MIN(jobs.available_at), jobs.host
+            LIMIT :count''', {'now': now, 'worker': worker, 'count': count})]
+
+    def claim(self, worker, hosts=4, jobs_per_host=20):
+        now = time.time()
+        lease_until = now + self._lease_seconds
+        jobs = []
+        with self._transaction():
+            for host in self._claimable_hosts(worker, now, hosts):
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO shards (host, worker, lease_until) VALUES (?, ?, ?)',
+                    (host, worker, lease_until))
+                rows = self._connection.execute('''
+                    SELECT id, kind, news_site_uid, url, attempts FROM jobs
+                    WHERE host = :host
+                      AND ((state = 'pending' AND available_at <= :now)
+                           OR (state = 'leased' AND lease_until < :now))
+                    ORDER BY kind = 'article', id
+                    LIMIT :count''', {'host': host, 'now': now, 'count': jobs_per_host}).fetchall()
+                self._connection.executemany('''
+                    UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?,
+                        attempts = attempts + 1
+                    WHERE id = ?''', [(worker, lease_until, row[0]) for row in rows])
+                jobs.extend(dict(zip(('id', 'kind', 'news_site_uid', 'url', 'attempts'),
+                                     row[:4] + (row[4] + 1,))) for row in rows)
+        return jobs
+
+    def renew(self, worker):
+        lease_until = time.time() + self._lease_seconds
+        with self._transaction():
+            self._connection.execute(
+                'UPDATE shards SET lease_until = ? WHERE worker = ?', (lease_until, worker))
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'leased'",
+                (lease_until, worker))
+
+    def done(self, job_id, news_site_uid=None, record=None):
+        # The article and the end of its job are saved together
+        with self._transaction():
+            if record:
+                self._connection.execute(
+                    'INSERT INTO results (job_id, news_site_uid, {}) VALUES (?, ?, {})'.format(
+                        ', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+                    (job_id, news_site_uid) + tuple(record.values()))
+            self._connection.execute(
+                "UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL WHERE id = ?",
+                (job_id,))
+
+    def retry(self, job_id, attempts, error):
+        if attempts >= self._max_attempts:
+            self._connection.execute(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL, error = ? WHERE id = ?",
+                (str(error), job_id))
+            return False
+        self._connection.execute('''
+            UPDATE jobs SET state = 'pending', lease_until = NULL, error = ?, available_at = ?
+            WHERE id = ?''',
+            (str(error), time.time() + self._retry_after * 2 ** (attempts - 1), job_id))
+        return True
+
+    def release(self, worker):
+        # A worker that stops hands back its hosts and the jobs it didn't run
+        with self._transaction():
+            self._connection.execute('DELETE FROM shards WHERE worker = ?', (worker,))
+            self._connection.execute('''
+                UPDATE jobs SET state = 'pending', lease_until = NULL, attempts = attempts - 1
+                WHERE worker = ? AND state = 'leased' ''', (worker,))
+
+    def results(self, after_id=0, limit=500):
+        return [(row[0], row[1], ArticleRecord(*row[2:])) for row in self._connection.execute(
+            'SELECT id, news_site_uid, {} FROM results WHERE id > ? ORDER BY id LIMIT ?'.format(
+                ', '.join(FIELDS)), (after_id, limit))]
+
+    def collected(self, result_ids):
+        with self._transaction():
+            self._connection.executemany('DELETE FROM results WHERE id = ?',
+                                         [(result_id,) for result_id in result_ids])
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self._connection.execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        counts['results'] = self._connection.execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0]
+        return counts
+
+    def is_idle(self):
+        # No job waiting or running, a leased homepage may still add articles
+        counts = self.counts()
+        return not (counts['pending'] or counts['leased'])
+
+    def close(self):
+        self._connection.close()
+
+
+def open_queue(settings=None):
+    settings = settings or queue_settings()
+    return JobQueue(settings['path'],
+                    settings['lease_seconds'],
+                    settings['max_attempts'],
+                    settings['retry_after'])
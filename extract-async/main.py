@@ -2,111 +2,209 @@ import argparse
 import logging
 import aiohttp
 import asyncio
-import csv
 import datetime
+import functools
+import os
+import sys
 
-import news_page_objects as news
-from common import config
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import metrics  # noqa: E402
+import news_page_objects as news  # noqa: E402
+import resilience  # noqa: E402
+import response_cache  # noqa: E402
+import selector_engine  # noqa: E402
+import writers  # noqa: E402
+from article_record import ArticleRecord  # noqa: E402
+from common import config  # noqa: E402
+from crawl_index import content_hash, open_index  # noqa: E402
+from frontier import Frontier, close_seen_urls, seen_urls  # noqa: E402
+from scheduler import FetchScheduler, scheduler_settings  # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ws")
 
 
-async def _fetch_links(news_site_uid, session):
-    error = 0
-    links = []
-    try:
-        homepage = news.HomePage(news_site_uid)
-        await homepage.visit(session)
-        links = homepage.article_links
-    except Exception as e:
-        logger.error('ERROR fetching links: {}'.format(e), exc_info=False)
-        error = 'ERROR fetching links: {}'.format(e)
-    return (error, links, news_site_uid)
+async def _visit_listing(news_site_uid, session, url):
+    page = news.HomePage(news_site_uid, url)
+    await resilience.call(news_site_uid, lambda: page.visit(session))
+    return page
 
 
-async def _fetch_article(news_site_uid, link, session):
-    article = None
-    error = 0
-    logger.info('Start fetching article at {}'.format(link))
-    try:
-        article = news.ArticlePage(news_site_uid, link)
-        await article.visit(session)
+async def _discover_articles(news_site_uid, session, index=None, limit=None, homepages=None):
+    # Visits the listing pages of the site in frontier order and yields the
+    # canonical url of every article found that is new or due for a
+    # re-check. An error on the homepage is raised, one on any other
+    # listing page only skips it. The urls found go in homepages.
+    frontier = Frontier(news_site_uid)
+    seen = seen_urls(index) if index else None
+    found = []
+    page = frontier.next_page()
+    while page:
+        url, depth = page
+        visit = functools.partial(_visit_listing, news_site_uid, session, url)
+        try:
+            listing = await (limit(news_site_uid, url, visit) if limit else visit())
+        except Exception as e:
+            if frontier.pages_visited == 1:
+                raise
+            logger.warning('ERROR fetching listing {}: {}'.format(url, e))
+            page = frontier.next_page()
+            continue
+        if homepages is not None:
+            homepages[news_site_uid] = found
+
+        for article_url in frontier.add_links(url, depth, listing.article_links,
+                                              listing.listing_links):
+            found.append(article_url)
+            # Only a url the filter may have seen can be in the index
+            if index and article_url in seen and index.should_skip(article_url):
+                continue
+            if seen is not None:
+                seen.add(article_url)
+            yield article_url
+        page = frontier.next_page()
+    logger.info('Found {} articles in {} listing pages of {}'.format(
+        len(found), frontier.pages_visited, news_site_uid))
+
+
+async def _visit_article(news_site_uid, link, session, index=None):
+    # Returns the article, or None and why it was left out. Fetch errors
+    # are raised once resilience.call gives up retrying.
+    article = news.ArticlePage(news_site_uid, link)
+    headers = index.conditional_headers(article.url_csv) if index else None
+    await resilience.call(news_site_uid, lambda: article.visit(session, headers))
 
-        if article and not article.body_csv:
-            logger.warning('Invalid article. There is no body')
-            error = 'Invalid article. There is no body'
-            article = None
+    if article.not_modified:
+        index.not_modified(article.url_csv)
+        return None, 'Article not modified'
+    if not article.body_csv:
+        logger.warning('Invalid article. There is no body')
+        return None, 'Invalid article. There is no body'
+    if index and not index.record(article.url_csv,
+                                  article.etag,
+                                  article.last_modified,
+                                  content_hash(article.title_csv, article.body_csv)):
+        return None, 'Article unchanged'
+    return article, 0
 
+
+async def _fetch_article(news_site_uid, link, session, index=None):
+    logger.info('Start fetching article at {}'.format(link))
+    try:
+        article, error = await _visit_article(news_site_uid, link, session, index)
     except Exception as e:
         logger.error('ERROR fetching article: {}'.format(e), exc_info=False)
-        error = 'ERROR fetching article {}: {}'.format(link, e)
+        return ('ERROR fetching article {}: {}'.format(link, e), None, news_site_uid)
 
     return (error, article, news_site_uid)
 
 
-async def _news_scraper(news_sites_selected):
-    tasks = []
+def _article_record(article):
+    return ArticleRecord(str(article.body_csv),
+                         str(article.fetched_at_csv),
+                         str(article.title_csv),
+                         str(article.url_csv))
+
+
+async def _crawl_site(news_site_uid, session, scheduler, index=None, homepages=None,
+                      stop=None):
+    # Articles are queued as soon as the listing page they are on resolves
+    articles = _discover_articles(news_site_uid, session, index, scheduler.limit, homepages)
+    try:
+        async for url in articles:
+            if stop and stop.is_set():
+                break
+            if resilience.breaker(news_site_uid).is_open:
+                logger.warning('Skipping the rest of {}, its circuit is open'.format(
+                    news_site_uid))
+                break
+            await scheduler.submit(
+                news_site_uid,
+                url,
+                functools.partial(_fetch_article, news_site_uid, url, session, index))
+    except Exception as e:
+        logger.error('ERROR fetching links: {}'.format(e), exc_info=False)
+    finally:
+        await articles.aclose()
+
+
+async def _scrape_round(news_sites_selected, session, scheduler, index=None, homepages=None,
+                        stop=None):
+    # One crawl of the selected sites over a session and scheduler that can
+    # outlive it. The article urls found on each homepage go in homepages.
+    # Once stop is set no more articles are queued or yielded, the ones not
+    # saved yet stay pending in the index and are fetched next time.
+    producers = [_crawl_site(news_site_uid, session, scheduler, index, homepages, stop)
+                 for news_site_uid in news_sites_selected]
+
+    # Yield articles as they arrive, skipping the ones with errors
+    results = scheduler.results(producers)
+    try:
+        async for error, article, news_site_uid in results:
+            if stop and stop.is_set():
+                break
+            if error != 0:
+                continue
+            try:
+                record = _article_record(article)
+            except Exception as e:
+                logger.error('ERROR reading article: {}'.format(e))
+                continue
+            yield news_site_uid, record
+    finally:
+        await results.aclose()
+
+
+async def _scrape_articles(news_sites_selected, index=None):
+    # The caller owns the crawl index, and checkpoints the articles it saves
+    settings = scheduler_settings()
+    timeout = resilience.request_timeout(settings['request_timeout'])
 
     logger.info('Beginning scraping')
-    async with aiohttp.ClientSession() as session:
-
-        logger.info('Fetching articles links...')
-        for news_site_uid in news_sites_selected:
-            tasks.append(_fetch_links(news_site_uid, session))
-        home_pages = await asyncio.gather(*tasks)
-
-        logger.info('Fetching articles...')
-        tasks = []
-        for index in range(len(home_pages)):
-            error = home_pages[index][0]
-            links = home_pages[index][1]
-            news_site_uid = home_pages[index][2]
-
-            # Check Error
-            if error == 0:
-                print(news_site_uid)
-            else:
-                logger.error(error)
-
-            for link in links:
-                tasks.append(_fetch_article(news_site_uid, link, session))
-
-        # Waiting for all Articles
-        articles = await asyncio.gather(*tasks)
-        # Filter Articles with Error Code 0
-        articles = list(filter(lambda article: article[0] == 0, articles))
-
-        csv_headers = list(filter(
-            lambda property: property.endswith('_csv'),
-            dir(articles[0][1])))
-        now = datetime.datetime.now().strftime('%d_%m_%Y')
-
-        for index in range(len(articles)):
-            error = articles[index][0]
-            article = articles[index][1]
-            news_site_uid = articles[index][2]
-
-        for home_page in home_pages:
-            home_name = home_page[2]
-            out_file_name = '{}_{}.csv'.format(home_name, now)
-            home_articles = list(
-                filter(lambda article: article[2] == home_name, articles)
-            )
-
-            with open(out_file_name, mode='w+') as file:
-                writer = csv.writer(file)
-                writer.writerow(csv_headers)
-
-                for article in home_articles:
-                    articlePage = article[1]
-                    try:
-                        r = [str(getattr(articlePage, h)) for h in csv_headers]
-                        writer.writerow(r)
-                    except Exception as e:
-                        logger.error('ERROR writing article: {}'.format(e))
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            scheduler = FetchScheduler(settings)
+            async for news_site_uid, record in _scrape_round(
+                    news_sites_selected, session, scheduler, index):
+                yield news_site_uid, record
+    finally:
+        news.shutdown_parser_executor()
+        response_cache.close_cache()
+        close_seen_urls(index)
     logger.info('Scraping Finished')
 
+
+async def _news_scraper(news_sites_selected, use_index=True, output_format=None):
+    index = open_index(config().get('crawl_index')) if use_index else None
+
+    def checkpoint(records):
+        if index:
+            index.checkpoint([record.url_csv for record in records])
+
+    now = datetime.datetime.now().strftime('%d_%m_%Y')
+    outputs = {}
+    try:
+        async for news_site_uid, record in _scrape_articles(news_sites_selected, index):
+            if news_site_uid not in outputs:
+                outputs[news_site_uid] = writers.open_writer(
+                    '{}_{}'.format(news_site_uid, now), checkpoint, output_format)
+            try:
+                outputs[news_site_uid].write(record)
+            except Exception as e:
+                logger.error('ERROR writing article: {}'.format(e))
+    finally:
+        for output in outputs.values():
+            output.close()
+            logger.info('Wrote {} articles to {}'.format(output.rows, output.path))
+        if index:
+            index.report()
+            index.close()
+        metrics.export()
+
+
 if __name__ == '__main__':
     news_site_choices = list(config()['news_sites'].keys())
 
@@ -117,9 +215,49 @@ if __name__ == '__main__':
                         help='The news sites list that you want to scrape',
                         choices=news_site_choices,
                         default=news_site_choices,)
+    parser.add_argument('-p',
+                        '--parse-workers',
+                        help='Parse pages in a pool of this many processes',
+                        type=int,
+                        default=None)
+
+    parser.add_argument('--parser-backend',
+                        help='The html parser used to run the queries',
+                        choices=selector_engine.BACKENDS,
+                        default=None)
+    parser.add_argument('--cache-mode',
+                        help='Cache responses on disk, or only replay the cached ones',
+                        choices=response_cache.MODES,
+                        default=None)
+    parser.add_argument('-f',
+                        '--format',
+                        help='The file format articles are written in',
+                        choices=writers.FORMATS,
+                        default=None)
+    parser.add_argument('--no-index',
+                        help='Fetch every article, even the ones crawled before',
+                        action='store_true')
+    parser.add_argument('--seed-index',
+                        help='Mark the articles of this newspaper.db as crawled',
+                        type=str,
+                        default=None)
 
-    news_sites_selected = parser.parse_args().names_list
+    args = parser.parse_args()
+    metrics.configure_from(config().get('metrics'))
+    if args.parse_workers:
+        news.use_process_pool(args.parse_workers)
+    if args.parser_backend:
+        news.use_parser_backend(args.parser_backend)
+    if args.cache_mode:
+        response_cache.use_cache_mode(args.cache_mode)
+
+    news_sites_selected = args.names_list
     print(news_sites_selected)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(_news_scraper(news_sites_selected))
+    if args.seed_index:
+        index = open_index(config()['crawl_index'])
+        index.seed_from_db(args.seed_index)
+        index.close()
+
+    loop.run_until_complete(_news_scraper(news_sites_selected, not args.no_index, args.format))
@@ -1,12 +1,27 @@
-import bs4
+import asyncio
+import concurrent.futures
+import datetime
 import re
+import time
+from urllib.parse import urlparse
 
+import metrics
+import resilience
+import response_cache
+import selector_engine
 from common import config
 
 # Regular expresion definitions
 is_well_former_link = re.compile(r'^https?://.+$')
 is_root_path = re.compile(r'^/.+$')
 
+__executor = None
+
+fetch_seconds = metrics.histogram('fetch_seconds', 'Time to download a page, per host')
+downloaded_bytes = metrics.counter('downloaded_bytes', 'Bytes of pages downloaded, per host')
+received = metrics.counter('responses', 'Responses received, per host and status')
+parse_seconds = metrics.histogram('parse_seconds', 'Time to parse a page, per page type')
+
 
 def _build_link(host, link):
     if is_well_former_link.match(link):
@@ -17,59 +32,144 @@ def _build_link(host, link):
         return '{host}/{uri}'.format(host=host, uri=link)
 
 
+def use_process_pool(workers=None):
+    config().setdefault('parser', {})
+    config()['parser'].update({'use_processes': True, 'workers': workers})
+
+
+def use_parser_backend(backend):
+    config().setdefault('parser', {})
+    config()['parser']['backend'] = backend
+
+
+def _parser_executor():
+    global __executor
+    settings = config().get('parser') or {}
+    if not __executor and settings.get('use_processes'):
+        __executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.get('workers') or None)
+
+    return __executor
+
+
+def shutdown_parser_executor():
+    global __executor
+    if __executor:
+        __executor.shutdown()
+        __executor = None
+
+
+def _parser_backend():
+    return (config().get('parser') or {}).get('backend') or 'html.parser'
+
+
+# Parsers run either on the event loop or inside a worker process, so they
+# take the raw html and only hand back the extracted fields
+def _parse_homepage(text, news_site_uid, queries, backend):
+    site_engine = selector_engine.engine(news_site_uid, queries, backend)
+    return site_engine.page_links(text)
+
+
+def _parse_article(text, news_site_uid, queries, backend):
+    site_engine = selector_engine.engine(news_site_uid, queries, backend)
+    return site_engine.article_fields(text)
+
+
 class NewsPage:
+    _parser = None
+
     def __init__(self, news_site_uid):
+        self._news_site_uid = news_site_uid
         self._config = config()['news_sites'][news_site_uid]
         self._queries = self._config['queries']
         self._url = self._config['url']
-        self._html = None
-
-    def _select(self, query_string):
-        return self._html.select(query_string)
-
-    def _select_list(self, query_string_list):
-        results = []
-        for query_string in query_string_list:
-            results = results + self._html.select(query_string)
-        return results
+        self._fields = None
+        self._fetched_at = None
+        self.etag = None
+        self.last_modified = None
+        self.not_modified = False
 
     @property
     def url_csv(self):
         return self._url
 
-    async def visit(self, session):
-        async with session.get(self._url) as response:
-            text = await response.text()
-            self._html = bs4.BeautifulSoup(text, 'html.parser')
+    @property
+    def fetched_at_csv(self):
+        return self._fetched_at.isoformat(timespec='seconds') if self._fetched_at else ''
+
+    async def _get(self, session, headers=None):
+        responses = response_cache.cache()
+        if responses:
+            cached = responses.get(self._url, response_cache.site_ttl(self._news_site_uid))
+            if cached:
+                text, self.etag, self.last_modified = cached
+                return text
+
+        host = urlparse(self._url).netloc
+        start = time.perf_counter()
+        with metrics.span('fetch', url=self._url):
+            async with session.get(self._url, headers=headers) as response:
+                received.inc(host=host, status=response.status)
+                self.etag = response.headers.get('ETag')
+                self.last_modified = response.headers.get('Last-Modified')
+                self.not_modified = response.status == 304
+                if self.not_modified:
+                    return None
+                if response.status >= 400:
+                    raise resilience.HttpStatusError(self._url, response.status)
+                downloaded_bytes.inc(len(await response.read()), host=host)
+                text = await response.text()
+        fetch_seconds.observe(time.perf_counter() - start, host=host)
+
+        if responses:
+            responses.put(self._url, text, self.etag, self.last_modified)
+        return text
+
+    async def visit(self, session, headers=None):
+        self._fetched_at = datetime.datetime.now()
+        text = await self._get(session, headers)
+        if self.not_modified:
+            return
 
+        args = (text, self._news_site_uid, self._queries, _parser_backend())
+        executor = _parser_executor()
+        page = type(self).__name__
+        with metrics.span('parse', url=self._url), parse_seconds.time(page=page):
+            if executor:
+                loop = asyncio.get_event_loop()
+                self._fields = await loop.run_in_executor(executor, self._parser, *args)
+            else:
+                self._fields = self._parser(*args)
 
+
+# The homepage of a site, or any other listing page of it given its url
 class HomePage(NewsPage):
-    def __init__(self, news_site_uid):
+    _parser = staticmethod(_parse_homepage)
+
+    def __init__(self, news_site_uid, url=None):
         super().__init__(news_site_uid)
+        self._url = url or self._url
 
     @property
     def article_links(self):
-        link_list = []
-        for link in self._select_list(self._queries['homepage_article_links']):
-            if link and link.has_attr('href'):
-                link_list.append(link)
-        return set(link['href'] for link in link_list)
+        return self._fields['article_links']
+
+    @property
+    def listing_links(self):
+        return self._fields['listing_links']
 
 
 class ArticlePage(NewsPage):
+    _parser = staticmethod(_parse_article)
+
     def __init__(self, news_site_uid, article_url):
         super().__init__(news_site_uid)
         self._url = _build_link(self._url, article_url)
 
     @property
     def body_csv(self):
-        results = self._select(self._queries['article_body'])
-        text = ''
-        for result in results:
-            text += result.text
-        return text
+        return self._fields['body']
 
     @property
     def title_csv(self):
-        result = self._select(self._queries['article_title'])
-        return result[0].text if len(result) else ''
+        return self._fields['title']
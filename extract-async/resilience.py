@@ -0,0 +1,142 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+import scheduler
+from common import config
+
+import logging
+logger = logging.getLogger("ws")
+
+_DEFAULT_SETTINGS = {
+    'connect_timeout': 10,
+    'read_timeout': 20,
+    'retries': 3,
+    'backoff': 0.5,
+    'max_backoff': 30,
+    'failure_threshold': 5,
+    'reset_after': 60,
+}
+
+# Worth another try: the server may answer next time
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+__breakers = {}
+
+
+class HttpStatusError(Exception):
+    def __init__(self, url, status):
+        super().__init__('{} answered {}'.format(url, status))
+        self.status = status
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def resilience_settings():
+    settings = dict(_DEFAULT_SETTINGS)
+    settings.update(config().get('resilience') or {})
+    return settings
+
+
+def request_timeout(total=None):
+    settings = resilience_settings()
+    return aiohttp.ClientTimeout(total=total,
+                                 sock_connect=settings['connect_timeout'],
+                                 sock_read=settings['read_timeout'])
+
+
+def is_transient(error):
+    if isinstance(error, HttpStatusError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def backoff(attempt, settings):
+    # Full jitter, so retries of many articles don't hit the host together
+    return random.uniform(0, min(settings['max_backoff'], settings['backoff'] * 2 ** attempt))
+
+
+# Stops the requests to a site after failure_threshold transient errors in
+# a row. After reset_after seconds a single request goes through, and its
+# result closes the circuit again or keeps it open.
+class CircuitBreaker:
+    def __init__(self, news_site_uid, failure_threshold, reset_after):
+        self._news_site_uid = news_site_uid
+        self._failure_threshold = failure_threshold
+        self._reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None and \
+            (self._probing or time.monotonic() - self._opened_at < self._reset_after)
+
+    def check(self):
+        if self._opened_at is None:
+            return
+        if self.is_open:
+            raise CircuitOpen('Circuit open for {}'.format(self._news_site_uid))
+        self._probing = True
+
+    def succeeded(self):
+        if self._opened_at is not None:
+            logger.info('Circuit closed for {}'.format(self._news_site_uid))
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def inconclusive(self):
+        # Ends a probe without a verdict, the next request probes again
+        self._probing = False
+
+    def failed(self):
+        self._failures += 1
+        self._probing = False
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                logger.warning('Circuit opened for {} after {} failures'.format(
+                    self._news_site_uid, self._failures))
+            self._opened_at = time.monotonic()
+
+
+def breaker(news_site_uid):
+    if news_site_uid not in __breakers:
+        settings = resilience_settings()
+        __breakers[news_site_uid] = CircuitBreaker(news_site_uid,
+                                                   settings['failure_threshold'],
+                                                   settings['reset_after'])
+    return __breakers[news_site_uid]
+
+
+async def call(news_site_uid, fetch):
+    # Runs fetch until it succeeds, fails with a permanent error or runs out
+    # of retries, with a growing, jittered pause between attempts
+    settings = resilience_settings()
+    site_breaker = breaker(news_site_uid)
+    for attempt in range(settings['retries'] + 1):
+        site_breaker.check()
+        try:
+            result = await fetch()
+        except Exception as e:
+            if not is_transient(e):
+                # Says nothing about the health of the site, a probe
+                # ending like this leaves the circuit as it was
+                site_breaker.inconclusive()
+                raise
+            site_breaker.failed()
+            if attempt == settings['retries']:
+                raise
+            delay = backoff(attempt, settings)
+            logger.warning('Retrying in {:.1f}s after: {}'.format(delay, e))
+            # Other fetches use the slots of this one while it waits
+            async with scheduler.released():
+                await asyncio.sleep(delay)
+        else:
+            site_breaker.succeeded()
+            return result
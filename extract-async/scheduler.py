@@ -0,0 +1,246 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from urllib.parse import urlparse
+
+import metrics
+from common import config
+
+logger = logging.getLogger("ws")
+
+_DEFAULT_SETTINGS = {
+    'max_concurrency': 20,
+    'queue_size': 100,
+    'request_timeout': 30,
+    'per_host': {
+        'max_concurrency': 4,
+        'rate_limit': 0,
+    },
+}
+
+_DONE = object()
+
+queue_depth = metrics.gauge('scheduler_queue_depth', 'Article jobs waiting to be fetched')
+in_flight = metrics.gauge('requests_in_flight', 'Requests being fetched, per host')
+
+# The slots held by the fetch running in the current task, so it can give
+# them back while it waits
+_held_slots = contextvars.ContextVar('held_slots', default=None)
+
+# The results() call the jobs submitted by the current task belong to
+_current_round = contextvars.ContextVar('current_round')
+
+
+def scheduler_settings():
+    settings = dict(_DEFAULT_SETTINGS)
+    settings.update(config().get('scheduler') or {})
+    per_host = dict(_DEFAULT_SETTINGS['per_host'])
+    per_host.update(settings.get('per_host') or {})
+    settings['per_host'] = per_host
+    return settings
+
+
+# Caps the requests in flight for a host and spaces them by its rate limit
+# (requests per second, 0 means no limit)
+class HostLimiter:
+    def __init__(self, max_concurrency, rate_limit):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._interval = 1.0 / rate_limit if rate_limit else 0
+        self._lock = asyncio.Lock()
+        self._next_slot = 0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        if not self._interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                self._semaphore.release()
+                raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+
+
+# The host and global slots of one fetch. The host slot is taken first, so
+# a fetch waiting on its host doesn't hold a global slot the fetches to
+# other hosts could use.
+class _Slots:
+    def __init__(self, host, host_limiter, global_limiter):
+        self._host = host
+        self._host_limiter = host_limiter
+        self._global_limiter = global_limiter
+        self._held = False
+
+    async def acquire(self):
+        await self._host_limiter.__aenter__()
+        try:
+            await self._global_limiter.acquire()
+        except BaseException:
+            await self._host_limiter.__aexit__(None, None, None)
+            raise
+        self._held = True
+        in_flight.inc(host=self._host)
+
+    async def release(self):
+        if not self._held:
+            return
+        self._held = False
+        in_flight.dec(host=self._host)
+        self._global_limiter.release()
+        await self._host_limiter.__aexit__(None, None, None)
+
+
+@contextlib.asynccontextmanager
+async def released():
+    # Gives the slots of the running fetch back for the block, e.g. the
+    # pause before a retry, and waits for them again after it
+    slots = _held_slots.get()
+    if slots is None:
+        yield
+        return
+    await slots.release()
+    try:
+        yield
+    finally:
+        await slots.acquire()
+
+
+# The jobs submitted by the producers of one results() call, and the queue
+# their results go to. Once the call ends, its jobs still queued are
+# skipped and the results of the ones running are dropped.
+class _Round:
+    def __init__(self, queue_size):
+        self.results = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def started(self):
+        self._unfinished += 1
+        self._finished.clear()
+
+    def done(self):
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def close(self):
+        self.closed = True
+        # Wakes the workers waiting to put a result nobody will read
+        while not self.results.empty():
+            self.results.get_nowait()
+
+
+# Runs fetch jobs from a bounded queue per host, each drained by as many
+# workers as the host takes requests at once. A host at its limit keeps
+# its jobs queued without holding a worker or a global slot, so the jobs
+# of other hosts go ahead of them. Several results() calls can run at
+# once, sharing the workers and limits.
+class FetchScheduler:
+    def __init__(self, settings=None):
+        self._settings = settings or scheduler_settings()
+        self._global = asyncio.Semaphore(self._settings['max_concurrency'])
+        self._hosts = {}
+        self._jobs = {}
+        self._workers = []
+        self._rounds = 0
+
+    def _host_limiter(self, news_site_uid, url):
+        host = urlparse(url).netloc
+        if host not in self._hosts:
+            limits = dict(self._settings['per_host'])
+            limits.update(config()['news_sites'][news_site_uid].get('limits') or {})
+            self._hosts[host] = HostLimiter(limits['max_concurrency'],
+                                            limits['rate_limit'])
+        return self._hosts[host]
+
+    async def limit(self, news_site_uid, url, fetch):
+        slots = _Slots(urlparse(url).netloc,
+                       self._host_limiter(news_site_uid, url),
+                       self._global)
+        await slots.acquire()
+        token = _held_slots.set(slots)
+        try:
+            return await fetch()
+        finally:
+            _held_slots.reset(token)
+            await slots.release()
+
+    def _host_jobs(self, news_site_uid, url):
+        host = urlparse(url).netloc
+        if host not in self._jobs:
+            self._jobs[host] = asyncio.Queue(maxsize=self._settings['queue_size'])
+            self._workers.extend(
+                asyncio.ensure_future(self._work(self._jobs[host]))
+                for _ in range(self._host_limiter(news_site_uid, url).max_concurrency))
+        return self._jobs[host]
+
+    def _queue_depth(self):
+        return sum(jobs.qsize() for jobs in self._jobs.values())
+
+    async def submit(self, news_site_uid, url, fetch):
+        # Called by the producers given to results(). Blocks while the queue
+        # of the host is full, so producers can't outrun workers.
+        job_round = _current_round.get()
+        job_round.started()
+        await self._host_jobs(news_site_uid, url).put((job_round, news_site_uid, url, fetch))
+        queue_depth.set(self._queue_depth())
+
+    async def _work(self, jobs):
+        while True:
+            job_round, news_site_uid, url, fetch = await jobs.get()
+            queue_depth.set(self._queue_depth())
+            try:
+                if job_round.closed:
+                    continue
+                result = await self.limit(news_site_uid, url, fetch)
+                if not job_round.closed:
+                    await job_round.results.put(result)
+            except Exception as e:
+                logger.error('ERROR running job {}: {}'.format(url, e))
+            finally:
+                job_round.done()
+
+    async def _feed(self, producers, job_round):
+        # Set in the task of the feeder, the producers inherit it
+        _current_round.set(job_round)
+        try:
+            await asyncio.gather(*producers)
+            await job_round.join()
+        finally:
+            if not job_round.closed:
+                await job_round.results.put(_DONE)
+
+    async def results(self, producers):
+        job_round = _Round(self._settings['queue_size'])
+        self._rounds += 1
+        feeder = asyncio.ensure_future(self._feed(producers, job_round))
+        try:
+            while True:
+                result = await job_round.results.get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            feeder.cancel()
+            job_round.close()
+            self._rounds -= 1
+            if not self._rounds:
+                for worker in self._workers:
+                    worker.cancel()
+                self._workers = []
+                self._jobs = {}
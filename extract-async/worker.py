@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import os
+import signal
+import sys
+
+import aiohttp
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import main  # noqa: E402
+import metrics  # noqa: E402
+import news_page_objects as news  # noqa: E402
+import resilience  # noqa: E402
+import response_cache  # noqa: E402
+from common import config  # noqa: E402
+from crawl_index import open_index  # noqa: E402
+from frontier import close_seen_urls  # noqa: E402
+from job_queue import open_queue, queue_settings, worker_name  # noqa: E402
+from scheduler import FetchScheduler, scheduler_settings  # noqa: E402
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ws")
+
+jobs_run = metrics.counter('queue_jobs', 'Queue jobs run by this worker, per kind and outcome')
+
+
+# The job queue with every call run in a thread of its own. A queue busy
+# with other workers blocks for up to its busy timeout, which on the event
+# loop would stall every fetch of the worker.
+class _QueueThread:
+    def __init__(self, queue):
+        self._queue = queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name):
+        method = getattr(self._queue, name)
+
+        async def call(*args):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(method, *args))
+        return call
+
+    async def close(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self._executor, self._queue.close)
+        self._executor.shutdown()
+
+
+async def _run_homepage(job, session, queue, index):
+    # The articles on the site's listing pages become article jobs
+    news_site_uid = job['news_site_uid']
+    urls = [url async for url in main._discover_articles(news_site_uid, session, index)]
+    await queue.add_articles(news_site_uid, urls)
+    await queue.done(job['id'])
+    logger.info('Queued {} articles of {}'.format(len(urls), news_site_uid))
+
+
+async def _run_article(job, session, queue, index):
+    news_site_uid = job['news_site_uid']
+    article, _ = await main._visit_article(news_site_uid, job['url'], session, index)
+    record = main._article_record(article) if article else None
+    await queue.done(job['id'], news_site_uid, record)
+    # Saved in the queue, so it counts as crawled
+    if record and index:
+        index.checkpoint([record.url_csv])
+
+
+RUNNERS = {
+    'homepage': _run_homepage,
+    'article': _run_article,
+}
+
+
+async def _run_job(job, session, scheduler, queue, index):
+    outcome = 'done'
+    try:
+        await scheduler.limit(job['news_site_uid'], job['url'],
+                              lambda: RUNNERS[job['kind']](job, session, queue, index))
+    except Exception as e:
+        logger.error('ERROR running {} job {}: {}'.format(job['kind'], job['url'], e))
+        outcome = 'retried' if await queue.retry(job['id'], job['attempts'], e) else 'failed'
+    finally:
+        # Other workers write to the same crawl index
+        if index:
+            index.commit()
+    jobs_run.inc(kind=job['kind'], outcome=outcome)
+
+
+async def _renew_leases(queue, worker, lease_seconds):
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        await queue.renew(worker)
+
+
+async def work(worker=None, exit_when_idle=True, use_index=True):
+    settings = queue_settings()
+    worker = worker or worker_name()
+    queue = _QueueThread(open_queue(settings))
+    index = open_index(config().get('crawl_index')) if use_index else None
+    timeout = resilience.request_timeout(scheduler_settings()['request_timeout'])
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    logger.info('Worker {} pulling jobs from {}'.format(worker, settings['path']))
+    renewing = asyncio.ensure_future(_renew_leases(queue, worker, settings['lease_seconds']))
+    ran = 0
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            scheduler = FetchScheduler()
+            while not stop.is_set():
+                jobs = await queue.claim(worker, settings['hosts_per_claim'],
+                                         settings['jobs_per_host'])
+                if jobs:
+                    await asyncio.gather(*[_run_job(job, session, scheduler, queue, index)
+                                           for job in jobs])
+                    ran += len(jobs)
+                    continue
+                if exit_when_idle and await queue.is_idle():
+                    break
+                try:
+                    await asyncio.wait_for(stop.wait(), settings['poll_interval'])
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        renewing.cancel()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signal_number)
+        await queue.release(worker)
+        await queue.close()
+        news.shutdown_parser_executor()
+        response_cache.close_cache()
+        close_seen_urls(index)
+        if index:
+            index.report()
+            index.close()
+        metrics.export()
+    logger.info('Worker {} stopped after {} jobs'.format(worker, ran))
+    return ran
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name',
+                        help='Name the worker leases jobs with, host-pid by default',
+                        type=str,
+                        default=None)
+    parser.add_argument('--keep-polling',
+                        help='Wait for new jobs instead of stopping once the queue is empty',
+                        action='store_true')
+    parser.add_argument('--no-index',
+                        help='Fetch every article, even the ones crawled before',
+                        action='store_true')
+    args = parser.parse_args()
+    metrics.configure_from(config().get('metrics'))
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(work(args.name, not args.keep_polling, not args.no_index))
@@ -1,12 +1,14 @@
+import os
 import yaml
 
 __config = None
+__config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
 
 
 def config():
     global __config
     if not __config:
-        with open('config.yaml', mode='r') as file:
-            __config = yaml.load(file)
+        with open(__config_path, mode='r') as file:
+            __config = yaml.safe_load(file)
 
     return __config
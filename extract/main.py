@@ -1,101 +1,163 @@
 import argparse
+import concurrent.futures
 import logging
-import re
+import os
+import sys
 from requests.exceptions import HTTPError
 from urllib3.exceptions import MaxRetryError
 import datetime
-import csv
 
-import news_page_objects as news
-from common import config
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import metrics  # noqa: E402
+import news_page_objects as news  # noqa: E402
+import response_cache  # noqa: E402
+import writers  # noqa: E402
+from article_record import ArticleRecord  # noqa: E402
+from common import config  # noqa: E402
+from crawl_index import content_hash, open_index  # noqa: E402
+from frontier import Frontier, close_seen_urls, seen_urls  # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ws")
 
-# Regular expresion definitions
-is_well_former_link = re.compile(r'^https?://.+$')
-is_root_path = re.compile(r'^/.+$')
-
-
-def _build_link(host, link):
-    if is_well_former_link.match(link):
-        return link
-    elif is_root_path.match(link):
-        return '{}{}'.format(host, link)
-    else:
-        return '{host}/{uri}'.format(host=host, uri=link)
-
 
-def _fetch_links(news_site_uid, host):
+def _discover_articles(news_site_uid, index=None):
+    # Visits the listing pages of the site in frontier order. Returns the
+    # canonical url of every article found, and of the ones among them that
+    # are new or due for a re-check.
     logger.info('Start fetching links at {}'.format(news_site_uid))
-    links = []
+    frontier = Frontier(news_site_uid)
+    seen = seen_urls(index) if index else None
+    found = []
+    urls = []
+    page = frontier.next_page()
+    while page:
+        url, depth = page
+        try:
+            listing = news.HomePage(news_site_uid, url)
+        except Exception as e:
+            logger.error('ERROR fetching links: {}'.format(e), exc_info=False)
+            listing = None
+
+        for article_url in frontier.add_links(url, depth, listing.article_links,
+                                              listing.listing_links) if listing else []:
+            found.append(article_url)
+            # Only a url the filter may have seen can be in the index
+            if index and article_url in seen and index.should_skip(article_url):
+                continue
+            if seen is not None:
+                seen.add(article_url)
+            urls.append(article_url)
+        page = frontier.next_page()
+    return found, urls
+
+
+def _download_article(news_site_uid, url, headers=None):
+    # Runs on the fetch threads, so it leaves the crawl index alone
+    logger.info('Start fetching article at {}'.format(url))
     try:
-        homepage = news.HomePage(news_site_uid, host)
-        links = homepage.article_links
-    except Exception as e:
-        logger.error('ERROR fetching links: {}'.format(e), exc_info=False)
-    return links
-
-
-def _fetch_article(news_site_uid, host, link):
-    logger.info('Start fetching article at {}'.format(link))
-    article = None
-    try:
-        article = news.ArticlePage(news_site_uid, _build_link(host, link))
+        return news.ArticlePage(news_site_uid, url, headers)
     except (HTTPError, MaxRetryError) as e:
         logger.warning('ERROR fetching article: {}'.format(e), exc_info=False)
     except Exception as e:
         logger.error('ERROR fetching article: {}'.format(e), exc_info=False)
+    return None
+
+
+def _checked_article(article, url, index=None):
+    if article and article._not_modified:
+        index.not_modified(url)
+        return None
 
     if article and not article.body:
         logger.warning('Invalid article. There is no body')
         return None
 
-    return article
-
+    if article and index and not index.record(url,
+                                              article._etag,
+                                              article._last_modified,
+                                              content_hash(article.title, article.body)):
+        logger.info('Article unchanged since the last crawl')
+        return None
 
-def _save_articles(news_site_uid, articles):
-    now = datetime.datetime.now().strftime('%d_%m_%Y')
-    out_file_name = '{news_site_uid}_{datetime}_articles.csv'.format(
-        news_site_uid=news_site_uid, datetime=now)
-    csv_headers = list(filter(
-        lambda property: not property.startswith('_'),
-        dir(articles[0])))
+    return article
 
-    with open(out_file_name, mode='w+') as file:
-        writer = csv.writer(file)
-        writer.writerow(csv_headers)
 
-        for article in articles:
-            try:
-                row = [str(getattr(article, prop)) for prop in csv_headers]
-                writer.writerow(row)
-            except Exception as e:
-                logger.error('ERROR fetching article: {}'.format(e))
+def _article_record(article):
+    return ArticleRecord(str(article.body),
+                         article.fetched_at.isoformat(timespec='seconds'),
+                         str(article.title),
+                         str(article.url))
 
 
-def _news_scraper(news_site_uid):
+def _news_scraper(news_site_uid, use_index=True, output_format=None, workers=None):
     host = config()['news_sites'][news_site_uid]['url']
+    workers = workers or news.fetch_settings()['workers']
     logger.info('Beginning scraper for {}'.format(host))
+    index = open_index(config().get('crawl_index')) if use_index else None
 
-    links = _fetch_links(news_site_uid, host)
-    articles = []
-    for link in links:
-        article = _fetch_article(news_site_uid, host, link)
+    def checkpoint(records):
+        # Only the saved articles count as crawled
+        if index:
+            index.checkpoint([record.url_csv for record in records])
+
+    now = datetime.datetime.now().strftime('%d_%m_%Y')
+    output = None
+    executor = None
+    try:
+        # The frontier hands the urls in the same order every run, and the
+        # articles are written in that order whatever the number of threads
+        links, urls = _discover_articles(news_site_uid, index)
+        requested = [(url, index.conditional_headers(url) if index else None) for url in urls]
+        if workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        # Articles are downloaded and parsed on the threads and handed back
+        # in link order, the index and the output file stay on this thread
+        downloads = (executor.map if executor else map)(
+            lambda request: _download_article(news_site_uid, *request), requested)
+        for (url, _), article in zip(requested, downloads):
+            article = _checked_article(article, url, index)
+            if not article:
+                continue
 
-        if article:
             logger.info('Article fetched!')
-            articles.append(article)
+            if output is None:
+                output = writers.open_writer(
+                    '{}_{}_articles'.format(news_site_uid, now), checkpoint, output_format)
+            try:
+                output.write(_article_record(article))
+            except Exception as e:
+                logger.error('ERROR fetching article: {}'.format(e))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if output:
+            output.close()
+        response_cache.close_cache()
+        close_seen_urls(index)
+        if index:
+            index.report()
+            index.close()
 
-    if articles:
-        _save_articles(news_site_uid, articles)
     print('Total de Links Encontrados: {}'.format(len(links)))
-    print('Total de Articulos Encontrados: {}'.format(len(articles)))
+    print('Total de Articulos Encontrados: {}'.format(output.rows if output else 0))
 
 
 if __name__ == '__main__':
     news_site_choices = list(config()['news_sites'].keys())
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w',
+                        '--workers',
+                        help='Fetch and parse the articles of a site on this many threads',
+                        type=int,
+                        default=None)
+    args = parser.parse_args()
+
     # # Genera CSV para el news_site ingresado por consola (primer argumento)
     # parser = argparse.ArgumentParser()
     # parser.add_argument('news_site',
@@ -107,5 +169,10 @@ if __name__ == '__main__':
     # _news_scraper(args.news_site)
 
     # Genera un archivo CSV por cada news_site configurada en config.yaml
+    metrics.configure_from(config().get('metrics'))
+    if args.workers:
+        news.use_fetch_workers(args.workers)
     for news_site in news_site_choices:
         _news_scraper(news_site)
+    news.close_sessions()
+    metrics.export()
@@ -1,62 +1,154 @@
-import bs4
+import abc
+import datetime
+import threading
+from urllib.parse import urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import response_cache
+import selector_engine
 from common import config
 
 
-class NewsPage:
-    def __init__(self, news_site_uid, url):
+fetch_seconds = metrics.histogram('fetch_seconds', 'Time to download a page, per host')
+downloaded_bytes = metrics.counter('downloaded_bytes', 'Bytes of pages downloaded, per host')
+received = metrics.counter('responses', 'Responses received, per host and status')
+parse_seconds = metrics.histogram('parse_seconds', 'Time to parse a page, per page type')
+
+__sessions = {}
+__sessions_lock = threading.Lock()
+
+
+def _parser_backend():
+    return (config().get('parser') or {}).get('backend') or 'html.parser'
+
+
+def fetch_settings():
+    settings = {'workers': 1, 'pool_size': 10, 'connect_timeout': 10, 'read_timeout': 30}
+    settings.update({name: value for name, value in (config().get('fetch') or {}).items()
+                     if value is not None})
+    return settings
+
+
+def use_fetch_workers(workers):
+    config().setdefault('fetch', {})
+    config()['fetch']['workers'] = workers
+
+
+def _session(host):
+    # One pooled session per host keeps its connections (and TLS sessions)
+    # alive between articles, shared by every fetch thread
+    with __sessions_lock:
+        if host not in __sessions:
+            settings = fetch_settings()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=max(settings['pool_size'], settings['workers']))
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            __sessions[host] = session
+
+        return __sessions[host]
+
+
+def close_sessions():
+    with __sessions_lock:
+        for session in __sessions.values():
+            session.close()
+        __sessions.clear()
+
+
+class NewsPage(abc.ABC):
+    def __init__(self, news_site_uid, url, headers=None):
+        self._news_site_uid = news_site_uid
         self._config = config()['news_sites'][news_site_uid]
         self._queries = self._config['queries']
-        self._html = None
+        self._engine = selector_engine.engine(
+            news_site_uid, self._queries, _parser_backend())
         self._url = url
-        self._visit(self._url)
-
-    def _select(self, query_string):
-        return self._html.select(query_string)
-
-    def _select_list(self, query_string_list):
-        results = []
-        for query_string in query_string_list:
-            results = results + self._html.select(query_string)
-        print(len(results))
-        return results
+        self._visit(self._url, headers)
 
     @property
     def url(self):
         return self._url
 
-    def _visit(self, url):
-        response = requests.get(url)
+    @property
+    def fetched_at(self):
+        return self._fetched_at
+
+    def _visit(self, url, headers=None):
+        self._fetched_at = datetime.datetime.now()
+        self._not_modified = False
+        responses = response_cache.cache()
+        if responses:
+            cached = responses.get(url, response_cache.site_ttl(self._news_site_uid))
+            if cached:
+                text, self._etag, self._last_modified = cached
+                self._extract_timed(text)
+                return
+
+        host = urlparse(url).netloc
+        settings = fetch_settings()
+        with metrics.span('fetch', url=url), fetch_seconds.time(host=host):
+            # A stalled server gives up the fetch thread instead of holding it
+            response = _session(host).get(
+                url, headers=headers,
+                timeout=(settings['connect_timeout'], settings['read_timeout']))
+        received.inc(host=host, status=response.status_code)
+        downloaded_bytes.inc(len(response.content), host=host)
         response.raise_for_status()
-        self._html = bs4.BeautifulSoup(response.text, 'html.parser')
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+        self._not_modified = response.status_code == 304
+        if not self._not_modified:
+            if responses:
+                responses.put(url, response.text, self._etag, self._last_modified)
+            self._extract_timed(response.text)
+
+    def _extract_timed(self, text):
+        with metrics.span('parse', url=self._url), \
+                parse_seconds.time(page=type(self).__name__):
+            self._extract(text)
 
+    @abc.abstractmethod
+    def _extract(self, text):
+        pass
 
+
+# The homepage of a site, or any other listing page of it
 class HomePage(NewsPage):
     def __init__(self, news_site_uid, url):
         super().__init__(news_site_uid, url)
 
+    def _extract(self, text):
+        links = self._engine.page_links(text)
+        self._article_links = links['article_links']
+        self._listing_links = links['listing_links']
+
     @property
     def article_links(self):
-        link_list = []
-        for link in self._select_list(self._queries['homepage_article_links']):
-            if link and link.has_attr('href'):
-                link_list.append(link)
-        return set(link['href'] for link in link_list)
+        return self._article_links
+
+    @property
+    def listing_links(self):
+        return self._listing_links
 
 
 class ArticlePage(NewsPage):
-    def __init__(self, news_site_uid, url):
-        super().__init__(news_site_uid, url)
+    def __init__(self, news_site_uid, url, headers=None):
+        super().__init__(news_site_uid, url, headers)
+
+    def _extract(self, text):
+        fields = self._engine.article_fields(text)
+        self._body = fields['body']
+        self._title = fields['title']
 
     @property
     def body(self):
-        results = self._select(self._queries['article_body'])
-        text = ''
-        for result in results:
-            text += result.text
-        return text
+        return self._body
 
     @property
     def title(self):
-        result = self._select(self._queries['article_title'])
-        return result[0].text if len(result) else ''
+        return self._title
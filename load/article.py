@@ -1,18 +1,26 @@
-from sqlalchemy import Column, String
+from sqlalchemy import Column, DateTime, Index, Integer, String
 from base import Base
 
 
 class Article(Base):
     __tablename__ = 'articles'
+    __table_args__ = (
+        Index('ix_articles_newspapper_uid_fetched_at', 'newspapper_uid', 'fetched_at'),
+        Index('ix_articles_host', 'host'),
+        Index('ix_articles_fetched_at', 'fetched_at'),
+    )
 
     id = Column(String, primary_key=True)
     body_csv = Column(String)
     host = Column(String)
     title_csv = Column(String)
     newspapper_uid = Column(String)
-    n_token_body_csv = Column(String)
-    n_token_title_csv = Column(String)
+    n_token_body_csv = Column(Integer)
+    n_token_title_csv = Column(Integer)
     url_csv = Column(String, unique=True)
+    body_hash = Column(String(32))
+    fetched_at = Column(DateTime)
+    loaded_at = Column(DateTime)
 
     def __init__(self,
                  uid,
@@ -22,7 +30,10 @@ class Article(Base):
                  n_token_body_csv,
                  n_token_title_csv,
                  title_csv,
-                 url_csv):
+                 url_csv,
+                 body_hash=None,
+                 fetched_at=None,
+                 loaded_at=None):
         self.id = uid
         self.body_csv = body_csv
         self.host = host
@@ -31,3 +42,6 @@ class Article(Base):
         self.n_token_title_csv = n_token_title_csv
         self.title_csv = title_csv
         self.url_csv = url_csv
+        self.body_hash = body_hash
+        self.fetched_at = fetched_at
+        self.loaded_at = loaded_at
@@ -1,8 +1,22 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-engine = create_engine('sqlite:///newspaper.db')
+db_path = os.environ.get('NEWSPAPER_DB') or \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'newspaper.db')
+engine = create_engine('sqlite:///{}'.format(db_path))
+
+
+@event.listens_for(engine, 'connect')
+def _tune_connection(dbapi_connection, connection_record):
+    # Set once per pooled connection: readers don't block the loads and a
+    # commit waits for the WAL write instead of a sync of the whole file
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
 
 Session = sessionmaker(bind=engine)
 
@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import os
+import uuid
+from urllib.parse import quote
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+dataset_path = os.environ.get('NEWSPAPER_DATASET') or os.path.join(BASE_DIR, 'dataset')
+
+# The columns of the dataset and the key of the loaded row each one comes
+# from. The files hold these, the folders hold the partition columns.
+COLUMNS = {
+    'uid': 'id',
+    'title_csv': 'title_csv',
+    'body_csv': 'body_csv',
+    'url_csv': 'url_csv',
+    'host': 'host',
+    'n_token_title_csv': 'n_token_title_csv',
+    'n_token_body_csv': 'n_token_body_csv',
+    'body_hash': 'body_hash',
+    'fetched_at': 'fetched_at',
+    'loaded_at': 'loaded_at',
+}
+
+# pyarrow is optional, only the dataset needs it, so it's imported by the
+# functions that use it.
+
+
+def _file_schema(pa):
+    return pa.schema([
+        ('uid', pa.string()),
+        ('title_csv', pa.string()),
+        ('body_csv', pa.string()),
+        ('url_csv', pa.string()),
+        ('host', pa.string()),
+        ('n_token_title_csv', pa.int32()),
+        ('n_token_body_csv', pa.int32()),
+        ('body_hash', pa.string()),
+        ('fetched_at', pa.timestamp('us')),
+        ('loaded_at', pa.timestamp('us')),
+    ])
+
+
+def _partition_schema(pa):
+    return pa.schema([('newspapper_uid', pa.string()), ('crawl_date', pa.date32())])
+
+
+def _partition_dir(path, newspapper_uid, crawl_date):
+    return os.path.join(path,
+                        'newspapper_uid={}'.format(quote(newspapper_uid, safe='')),
+                        'crawl_date={}'.format(crawl_date.isoformat()))
+
+
+def _write_file(pq, table, directory, name):
+    # Files starting with _ are skipped by readers, so a half written part
+    # is never read
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, '_{}'.format(name))
+    pq.write_table(table, temporary)
+    os.replace(temporary, os.path.join(directory, name))
+
+
+def _part_name():
+    return 'part-{}-{}.parquet'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'),
+                                       uuid.uuid4().hex[:8])
+
+
+# Every load appends one file per site and crawl date (the day the article
+# was fetched) it has articles for, under
+# newspapper_uid=<site>/crawl_date=<YYYY-MM-DD>/. Nothing is rewritten, so
+# an article loaded again is in the dataset once per load until compact()
+# keeps its last load only.
+def write_articles(rows, path=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    path = path or dataset_path
+    schema = _file_schema(pa)
+    partitions = {}
+    for row in rows:
+        key = (row['newspapper_uid'], row['fetched_at'].date())
+        partitions.setdefault(key, []).append(row)
+
+    name = _part_name()
+    for (newspapper_uid, crawl_date), partition_rows in sorted(partitions.items()):
+        table = pa.table({column: [row[key] for row in partition_rows]
+                          for column, key in COLUMNS.items()}, schema=schema)
+        _write_file(pq, table, _partition_dir(path, newspapper_uid, crawl_date), name)
+    return len(partitions)
+
+
+def _dataset(path=None):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    schema = pa.unify_schemas([_file_schema(pa), _partition_schema(pa)])
+    partitioning = ds.partitioning(_partition_schema(pa), flavor='hive')
+    # Memory mapped, the columns read are sliced from the page cache
+    # instead of copied into buffers
+    return ds.dataset(path or dataset_path,
+                      schema=schema,
+                      format='parquet',
+                      partitioning=partitioning,
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def read_articles(columns=None, newspapper_uid=None, since=None, until=None, path=None):
+    # Only the folders of the sites and dates asked for are opened, and only
+    # the columns asked for are read from them. Returns a pyarrow Table,
+    # to_pandas() turns it into a DataFrame.
+    import pyarrow.dataset as ds
+    conditions = []
+    if newspapper_uid:
+        uids = [newspapper_uid] if isinstance(newspapper_uid, str) else list(newspapper_uid)
+        conditions.append(ds.field('newspapper_uid').isin(uids))
+    if since:
+        conditions.append(ds.field('crawl_date') >= since)
+    if until:
+        conditions.append(ds.field('crawl_date') <= until)
+
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    return _dataset(path).to_table(columns=columns, filter=condition)
+
+
+def _latest(table):
+    # The last load of every article
+    table = table.sort_by([('loaded_at', 'descending')])
+    seen = set()
+    keep = []
+    for uid in table.column('uid').to_pylist():
+        keep.append(uid not in seen)
+        seen.add(uid)
+    return table.filter(keep)
+
+
+def compact(newspapper_uid=None, path=None):
+    # Merges the files of every partition into one, with the last load of
+    # each article only. Readers see both the merged file and the old ones
+    # for as long as it takes to delete them.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    path = path or dataset_path
+    schema = _file_schema(pa)
+    compacted = 0
+    for directory, _, files in sorted(os.walk(path)):
+        parts = sorted(name for name in files
+                       if name.endswith('.parquet') and not name.startswith(('_', '.')))
+        if len(parts) < 2 or (newspapper_uid and 'newspapper_uid={}'.format(
+                quote(newspapper_uid, safe='')) not in directory.split(os.sep)):
+            continue
+        table = pa.concat_tables([pq.read_table(os.path.join(directory, name), schema=schema)
+                                  for name in parts])
+        table = _latest(table).sort_by([('fetched_at', 'ascending'), ('uid', 'ascending')])
+        _write_file(pq, table, directory, _part_name())
+        for name in parts:
+            os.remove(os.path.join(directory, name))
+        compacted += 1
+    return compacted
+
+
+def articles_per_site_per_day(since=None, newspapper_uid=None, path=None):
+    # Reads the uids and the partition folders, no article text
+    table = read_articles(['uid', 'newspapper_uid', 'crawl_date'],
+                          newspapper_uid, since, path=path)
+    rows = (table.group_by(['newspapper_uid', 'crawl_date'])
+            .aggregate([('uid', 'count_distinct')])
+            .sort_by([('newspapper_uid', 'ascending'), ('crawl_date', 'ascending')]))
+    return list(zip(*[rows.column(column).to_pylist()
+                      for column in ['newspapper_uid', 'crawl_date', 'uid_count_distinct']]))
+
+
+def token_count_summary(since=None, newspapper_uid=None, path=None):
+    table = _latest(read_articles(['uid', 'loaded_at', 'newspapper_uid',
+                                   'n_token_body_csv', 'n_token_title_csv'],
+                                  newspapper_uid, since, path=path))
+    rows = (table.group_by('newspapper_uid')
+            .aggregate([([], 'count_all'),
+                        ('n_token_body_csv', 'min'),
+                        ('n_token_body_csv', 'mean'),
+                        ('n_token_body_csv', 'max'),
+                        ('n_token_title_csv', 'mean')])
+            .sort_by('newspapper_uid'))
+    return list(zip(*[rows.column(column).to_pylist()
+                      for column in ['newspapper_uid', 'count_all', 'n_token_body_csv_min',
+                                     'n_token_body_csv_mean', 'n_token_body_csv_max',
+                                     'n_token_title_csv_mean']]))
+
+
+def _print_rows(rows):
+    for row in rows:
+        print('\t'.join(str(value) for value in row))
+
+
+if __name__ == '__main__':
+    reports = {
+        'per-day': lambda args: articles_per_site_per_day(args.since, args.newspapper_uid),
+        'summary': lambda args: token_count_summary(args.since, args.newspapper_uid),
+        'compact': lambda args: [('Partitions compacted', compact(args.newspapper_uid))],
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('report',
+                        help='The aggregation to print, or compact to merge the files '
+                             'of every partition',
+                        choices=list(reports.keys()))
+    parser.add_argument('-n',
+                        '--newspapper-uid',
+                        help='Only read the articles of this news site',
+                        default=None)
+    parser.add_argument('--since',
+                        help='Only read articles crawled from this date (YYYY-MM-DD)',
+                        type=datetime.date.fromisoformat,
+                        default=None)
+    args = parser.parse_args()
+
+    _print_rows(reports[args.report](args))
@@ -1,32 +1,131 @@
 import argparse
-import pandas as pd
+import datetime
+import hashlib
+import os
+import sys
+import time
+from sqlalchemy.dialects.sqlite import insert
 
-from article import Article
-from base import Base, Session, engine
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import dataset  # noqa: E402
+import metrics  # noqa: E402
+from article import Article  # noqa: E402
+from base import engine  # noqa: E402
+from migrate import ensure_schema  # noqa: E402
+from search import index_articles  # noqa: E402
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The column of the articles table each field of an extracted article ends
+# up in, see article_record.py in the extractors
+EXTRACTED_FIELDS = {
+    'body_csv': 'body_csv',
+    'fetched_at_csv': 'fetched_at',
+    'title_csv': 'title_csv',
+    'url_csv': 'url_csv',
+}
+
+loaded_rows = metrics.counter('load_rows', 'Articles upserted into the DB')
+batch_seconds = metrics.histogram('load_batch_seconds', 'Time to upsert and index a batch')
+insert_rate = metrics.gauge('load_rows_per_second', 'Insert rate of the last load')
+dataset_rows = metrics.counter('load_dataset_rows', 'Articles appended to the parquet dataset')
+
+ARTICLE_COLUMNS = ['uid',
+                   'body_csv',
+                   'host',
+                   'newspapper_uid',
+                   'n_token_body_csv',
+                   'n_token_title_csv',
+                   'title_csv',
+                   'url_csv']
+
+
+__dataset_path = None
+
+
+def use_dataset(path=None):
+    # Also appends the loaded articles to the parquet dataset, in path or
+    # in the default one
+    global __dataset_path
+    __dataset_path = path or dataset.dataset_path
+
+
+def _upsert_statement():
+    table = Article.__table__
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={column.name: statement.excluded[column.name]
+              for column in table.columns if not column.primary_key})
 
-def _main(filename):
-    Base.metadata.create_all(engine)
-    session = Session()
-    articles = pd.read_csv(filename)
 
-    for index, row in articles.iterrows():
-        logger.info('Loading article uid {} into DB'.format(row['uid']))
-        article = Article(row['uid'],
-                          row['body_csv'],
-                          row['host'],
-                          row['newspapper_uid'],
-                          row['n_token_body_csv'],
-                          row['n_token_title_csv'],
-                          row['title_csv'],
-                          row['url_csv'])
-        session.add(article)
-    session.commit()
-    session.close()
+def _fetched_at(articles, loaded_at):
+    # CSVs from before the extractors recorded fetched_at_csv
+    if 'fetched_at_csv' not in articles:
+        return [loaded_at] * len(articles)
+    import pandas as pd
+    return [timestamp.to_pydatetime() if not pd.isna(timestamp) else loaded_at
+            for timestamp in pd.to_datetime(articles['fetched_at_csv'])]
+
+
+def _article_rows(articles):
+    loaded_at = datetime.datetime.now()
+    fetched_at = _fetched_at(articles, loaded_at)
+    rows = []
+    for position, row in enumerate(articles[ARTICLE_COLUMNS].itertuples(index=False)):
+        values = row._asdict()
+        values['id'] = values.pop('uid')
+        values['n_token_body_csv'] = int(values['n_token_body_csv'])
+        values['n_token_title_csv'] = int(values['n_token_title_csv'])
+        values['body_hash'] = hashlib.md5(values['body_csv'].encode()).hexdigest()
+        values['fetched_at'] = fetched_at[position]
+        values['loaded_at'] = loaded_at
+        rows.append(values)
+    return rows
+
+
+def _load_articles(articles, batch_size=500):
+    start = time.perf_counter()
+    rows = _article_rows(articles)
+    statement = _upsert_statement()
+
+    with metrics.span('load', rows=len(rows)), engine.connect() as connection:
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            with batch_seconds.time(), connection.begin():
+                connection.execute(statement, batch)
+                index_articles(connection, [(row['id'], row['title_csv'], row['body_csv'])
+                                            for row in batch])
+            loaded_rows.inc(len(batch))
+            logger.info('Loaded {} of {} articles into DB'.format(
+                offset + len(batch), len(rows)))
+
+    # Only what made it into the DB goes to the dataset
+    if __dataset_path and rows:
+        with metrics.span('load.dataset', rows=len(rows)):
+            dataset.write_articles(rows, __dataset_path)
+        dataset_rows.inc(len(rows))
+
+    elapsed = time.perf_counter() - start
+    insert_rate.set(len(rows) / elapsed if elapsed else 0)
+    logger.info('Loaded {} articles in {:.2f}s ({:.0f} rows/sec)'.format(
+        len(rows), elapsed, len(rows) / elapsed if elapsed else 0))
+    return len(rows)
+
+
+def _main(filename, batch_size=500):
+    # Imported here so the CLI starts without pandas, the pipeline hands
+    # over frames it already built
+    import pandas as pd
+    ensure_schema()
+    articles = pd.read_csv(filename)
+    _load_articles(articles, batch_size)
+    metrics.export()
 
 
 if __name__ == '__main__':
@@ -34,5 +133,22 @@ if __name__ == '__main__':
     parser.add_argument('filename',
                         help='The file you want to load into the db',
                         type=str)
+    parser.add_argument('-b',
+                        '--batch-size',
+                        help='Articles inserted per statement',
+                        type=int,
+                        default=500)
+    parser.add_argument('--dataset',
+                        help='Also append the articles to the parquet dataset (needs pyarrow)',
+                        action='store_true')
+    parser.add_argument('--metrics-file',
+                        help='Write the metrics here, as JSON if it ends in .json',
+                        default=None)
+    parser.add_argument('--trace-file',
+                        help='Append the spans of the load here, one JSON per line',
+                        default=None)
     args = parser.parse_args()
-    _main(args.filename)
+    metrics.configure(args.metrics_file, args.trace_file)
+    if args.dataset:
+        use_dataset()
+    _main(args.filename, args.batch_size)
@@ -0,0 +1,102 @@
+import argparse
+import contextlib
+import hashlib
+from sqlalchemy import text
+
+from article import Article
+from base import Base, engine
+from search import create_search_index, drop_search_index, rebuild_search_index
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _md5(value):
+    return hashlib.md5(value.encode()).hexdigest() if value is not None else None
+
+
+# Version 1: typed token counts, body hash, fetch/load timestamps and the
+# secondary indexes. SQLite can't change column types, so the table is
+# rebuilt and the rows copied over.
+def _migrate_to_1(connection):
+    connection.connection.create_function('md5', 1, _md5)
+    if engine.dialect.has_table(connection, 'articles_v0'):
+        # Left by a run that failed before migrations were one transaction,
+        # the copy starts again and keeps whatever articles already holds
+        logger.warning('Resuming the copy of articles_v0 into articles')
+    else:
+        connection.execute(text('ALTER TABLE articles RENAME TO articles_v0'))
+    Base.metadata.create_all(connection, tables=[Article.__table__])
+    connection.execute(text('''
+        INSERT OR IGNORE INTO articles (id, body_csv, host, title_csv, newspapper_uid,
+                              n_token_body_csv, n_token_title_csv, url_csv,
+                              body_hash, fetched_at, loaded_at)
+        SELECT id, body_csv, host, title_csv, newspapper_uid,
+               CAST(n_token_body_csv AS INTEGER), CAST(n_token_title_csv AS INTEGER),
+               url_csv, md5(body_csv), NULL, NULL
+        FROM articles_v0'''))
+    connection.execute(text('DROP TABLE articles_v0'))
+
+
+# Version 2: full text search index over titles and bodies, filled by
+# version 3
+def _migrate_to_2(connection):
+    create_search_index(connection)
+
+
+# Version 3: the search index keeps the article id instead of sharing the
+# rowid of articles, and holds the raw texts
+def _migrate_to_3(connection):
+    drop_search_index(connection)
+    create_search_index(connection)
+    rebuild_search_index(connection)
+
+
+MIGRATIONS = [_migrate_to_1, _migrate_to_2, _migrate_to_3]
+
+
+def _schema_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+@contextlib.contextmanager
+def _ddl_transaction():
+    # pysqlite only opens a transaction before INSERT, UPDATE or DELETE, so
+    # every CREATE, ALTER or DROP would commit on its own. With its
+    # isolation level off, an explicit BEGIN makes the whole migration one
+    # transaction, rolled back as a whole if any step fails.
+    with engine.connect() as connection:
+        dbapi_connection = connection.connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            with connection.begin():
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+                yield connection
+        finally:
+            dbapi_connection.isolation_level = isolation_level
+
+
+def ensure_schema():
+    with _ddl_transaction() as connection:
+        if not engine.dialect.has_table(connection, Article.__tablename__) and \
+                not engine.dialect.has_table(connection, 'articles_v0'):
+            Base.metadata.create_all(connection)
+            create_search_index(connection)
+            connection.execute(text('PRAGMA user_version = {}'.format(len(MIGRATIONS))))
+            return
+
+        version = _schema_version(connection)
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info('Migrating {} to schema version {}'.format(
+                engine.url.database, target))
+            migration(connection)
+            connection.execute(text('PRAGMA user_version = {}'.format(target)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Brings newspaper.db up to the current articles schema')
+    parser.parse_args()
+    ensure_schema()
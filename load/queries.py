@@ -0,0 +1,100 @@
+import argparse
+import datetime
+from sqlalchemy import func
+
+from article import Article
+from base import Session
+
+# Common aggregations over newspaper.db. Every query filters or groups on
+# indexed columns: newspapper_uid + fetched_at, host and fetched_at.
+
+
+def articles_per_site_per_day(session, since=None, newspapper_uid=None):
+    day = func.date(Article.fetched_at).label('day')
+    query = (session
+             .query(Article.newspapper_uid, day, func.count().label('articles'))
+             .filter(Article.fetched_at.isnot(None)))
+    if newspapper_uid:
+        query = query.filter(Article.newspapper_uid == newspapper_uid)
+    if since:
+        since = datetime.datetime.combine(since, datetime.time())
+        query = query.filter(Article.fetched_at >= since)
+    return (query
+            .group_by(Article.newspapper_uid, day)
+            .order_by(Article.newspapper_uid, day)
+            .all())
+
+
+def articles_per_host(session):
+    return (session
+            .query(Article.host, func.count().label('articles'))
+            .group_by(Article.host)
+            .order_by(func.count().desc())
+            .all())
+
+
+def token_count_distribution(session, column='n_token_body_csv', bucket_size=50,
+                             newspapper_uid=None):
+    tokens = getattr(Article, column)
+    bucket = (tokens - tokens % bucket_size).label('bucket')
+    query = session.query(bucket, func.count().label('articles'))
+    if newspapper_uid:
+        query = query.filter(Article.newspapper_uid == newspapper_uid)
+    return query.group_by(bucket).order_by(bucket).all()
+
+
+def token_count_summary(session, newspapper_uid=None):
+    query = session.query(Article.newspapper_uid,
+                          func.count().label('articles'),
+                          func.min(Article.n_token_body_csv).label('min_body_tokens'),
+                          func.avg(Article.n_token_body_csv).label('avg_body_tokens'),
+                          func.max(Article.n_token_body_csv).label('max_body_tokens'),
+                          func.avg(Article.n_token_title_csv).label('avg_title_tokens'))
+    if newspapper_uid:
+        query = query.filter(Article.newspapper_uid == newspapper_uid)
+    return query.group_by(Article.newspapper_uid).all()
+
+
+def _print_rows(rows):
+    for row in rows:
+        print('\t'.join(str(value) for value in row))
+
+
+if __name__ == '__main__':
+    reports = {
+        'per-day': lambda session, args: articles_per_site_per_day(
+            session, args.since, args.newspapper_uid),
+        'per-host': lambda session, args: articles_per_host(session),
+        'tokens': lambda session, args: token_count_distribution(
+            session, args.column, args.bucket_size, args.newspapper_uid),
+        'summary': lambda session, args: token_count_summary(
+            session, args.newspapper_uid),
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('report',
+                        help='The aggregation to print',
+                        choices=list(reports.keys()))
+    parser.add_argument('-n',
+                        '--newspapper-uid',
+                        help='Only count the articles of this news site',
+                        default=None)
+    parser.add_argument('--since',
+                        help='Only count articles fetched from this date (YYYY-MM-DD)',
+                        type=datetime.date.fromisoformat,
+                        default=None)
+    parser.add_argument('--column',
+                        help='Token count column for the tokens report',
+                        choices=['n_token_body_csv', 'n_token_title_csv'],
+                        default='n_token_body_csv')
+    parser.add_argument('--bucket-size',
+                        help='Width of the token count buckets',
+                        type=int,
+                        default=50)
+    args = parser.parse_args()
+
+    session = Session()
+    try:
+        _print_rows(reports[args.report](session, args))
+    finally:
+        session.close()
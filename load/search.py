@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import re
+import unicodedata
+from sqlalchemy import bindparam, text
+
+from base import engine
+
+# Documents and queries are both split and normalized by fts5's unicode61
+# tokenizer, with case and accents folded. Neither side drops stopwords,
+# so a query word is always looked up in an index that kept it (bm25 gives
+# the common ones little weight), and loading needs no nltk.
+FTS_TABLE = 'articles_fts'
+TITLE_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+word_pattern = re.compile(r'\w+')
+
+
+def create_search_index(connection):
+    connection.execute(text('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(
+            article_id UNINDEXED, title, body,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )'''.format(FTS_TABLE)))
+
+
+def drop_search_index(connection):
+    connection.execute(text('DROP TABLE IF EXISTS {}'.format(FTS_TABLE)))
+
+
+def _fts_rowid(article_id):
+    # Derived from the article id rather than the rowid of articles, which a
+    # VACUUM may renumber, so a re-loaded article replaces its own entry
+    return int.from_bytes(hashlib.blake2b(article_id.encode(), digest_size=8).digest(),
+                          'little', signed=True)
+
+
+def _text(value):
+    return value if isinstance(value, str) else ''
+
+
+def index_articles(connection, articles):
+    # Takes (id, title, body) tuples of the articles just written
+    if not articles:
+        return
+    connection.execute(
+        text('DELETE FROM {} WHERE rowid IN :rowids'.format(FTS_TABLE))
+        .bindparams(bindparam('rowids', expanding=True)),
+        {'rowids': [_fts_rowid(article_id) for article_id, _, _ in articles]})
+    connection.execute(
+        text('INSERT INTO {} (rowid, article_id, title, body) '
+             'VALUES (:rowid, :article_id, :title, :body)'.format(FTS_TABLE)),
+        [{'rowid': _fts_rowid(article_id),
+          'article_id': article_id,
+          'title': _text(title),
+          'body': _text(body)} for article_id, title, body in articles])
+
+
+def rebuild_search_index(connection):
+    connection.execute(text('DELETE FROM {}'.format(FTS_TABLE)))
+    result = connection.execute(text('SELECT id, title_csv, body_csv FROM articles'))
+    while True:
+        rows = result.fetchmany(500)
+        if not rows:
+            break
+        index_articles(connection, [tuple(row) for row in rows])
+
+
+def _strip_accents(word):
+    return ''.join(char for char in unicodedata.normalize('NFD', word)
+                   if unicodedata.category(char) != 'Mn').lower()
+
+
+def _snippet(body, terms, width=12):
+    # Around the longest term found, stopwords are kept in the query and
+    # would make most snippets start at the first "de"
+    words = body.split()
+    wanted = sorted(set(_strip_accents(term) for term in terms), key=len, reverse=True)
+    found = {}
+    for position, word in enumerate(words):
+        match = word_pattern.search(word)
+        if match:
+            found.setdefault(_strip_accents(match.group()), position)
+    for term in wanted:
+        if term in found:
+            position = found[term]
+            start = max(0, position - width // 2)
+            window = words[start:position + width // 2 + 1]
+            window[position - start] = '[{}]'.format(words[position])
+            return '{}{}{}'.format('... ' if start else '',
+                                   ' '.join(window),
+                                   ' ...' if position + width // 2 + 1 < len(words) else '')
+    return ' '.join(words[:width]) + (' ...' if len(words) > width else '')
+
+
+def search(query, limit=20, newspapper_uid=None):
+    terms = word_pattern.findall(query)
+    if not terms:
+        return []
+    # Quoted terms, so words like "and" or "near" are not read as operators
+    match = ' '.join('"{}"'.format(term) for term in terms)
+    sql = '''
+        SELECT articles.id, articles.title_csv, articles.url_csv,
+               articles.newspapper_uid, articles.body_csv,
+               bm25({fts}, {title_weight}, {body_weight}) AS rank
+        FROM {fts} JOIN articles ON articles.id = {fts}.article_id
+        WHERE {fts} MATCH :match {site_filter}
+        ORDER BY rank
+        LIMIT :limit'''.format(
+            fts=FTS_TABLE,
+            title_weight=TITLE_WEIGHT,
+            body_weight=BODY_WEIGHT,
+            site_filter='AND articles.newspapper_uid = :site' if newspapper_uid else '')
+
+    with engine.connect() as connection:
+        rows = connection.execute(text(sql), {'match': match,
+                                              'limit': limit,
+                                              'site': newspapper_uid}).fetchall()
+    return [{
+        'id': row[0],
+        'title': row[1],
+        'url': row[2],
+        'newspapper_uid': row[3],
+        'rank': row[5],
+        'snippet': _snippet(row[4] or '', terms),
+    } for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('query',
+                        help='The words you are looking for',
+                        type=str)
+    parser.add_argument('-l',
+                        '--limit',
+                        help='Maximum number of results',
+                        type=int,
+                        default=20)
+    parser.add_argument('-n',
+                        '--newspapper-uid',
+                        help='Only search the articles of this news site',
+                        default=None)
+    parser.add_argument('--rebuild',
+                        help='Rebuild the whole index before searching',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        with engine.begin() as connection:
+            rebuild_search_index(connection)
+
+    for result in search(args.query, args.limit, args.newspapper_uid):
+        print('{:.3f}\t{}\t{}'.format(result['rank'], result['title'], result['url']))
+        print('\t{}'.format(result['snippet']))
@@ -1,42 +1,257 @@
-import subprocess
+import argparse
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import importlib.util
+import os
+import sys
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-news_sites_uids = ['impactolocal']
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, 'shared'))
 
-def _extract():
-    logger.info('Starting Extract Process...')
-    subprocess.run(['python', 'main.py', '-l'] + news_sites_uids, cwd='./extract-async')
-    for news_site_uid in news_sites_uids:
-        subprocess.run(['find', '.', '-name', '{}*'.format(news_site_uid),
-                        '-exec', 'mv', '{}', '../transform/{}_.csv'.format(news_site_uid), ';'],
-                        cwd='./extract-async')
 
+def _import_stage(stage_dir, module_name, alias):
+    # Every stage is a folder of scripts importing their siblings by bare
+    # name, so the folder goes on sys.path and the module gets an alias
+    # (extract-async/main.py and load/main.py would collide otherwise).
+    path = os.path.join(BASE_DIR, stage_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(
+        alias, os.path.join(path, '{}.py'.format(module_name)))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[alias] = module
+    spec.loader.exec_module(module)
+    return module
 
-def _transform():
-    logger.info('Starting transform process...')
-    for news_site_uid in news_sites_uids:
-        dirty_data_filename = '{}_.csv'.format(news_site_uid)
-        clean_data_filename = 'clean_{}'.format(dirty_data_filename)
-        subprocess.run(['python', 'news_papper_recipe.py', dirty_data_filename], cwd='./transform')
-        subprocess.run(['rm', dirty_data_filename], cwd='./transform')
-        subprocess.run(['mv', clean_data_filename, '../load/{}.csv'.format(news_site_uid)], cwd='./transform')
 
+extract = _import_stage('extract-async', 'main', 'extract_async_main')
+transform = _import_stage('transform', 'news_papper_recipe', 'news_papper_recipe')
+load = _import_stage('load', 'main', 'load_main')
 
-def _load():
-    logger.info('Starting load process...')
-    for news_site_uid in news_sites_uids:
-        clean_data_filename = '{}.csv'.format(news_site_uid)
-        subprocess.run(['python', 'main.py', clean_data_filename], cwd='./load')
-        subprocess.run(['rm', clean_data_filename], cwd='./load')
+import metrics  # noqa: E402
+from article_record import FIELDS, SchemaError, check_fields  # noqa: E402
+
+
+def _check_schema():
+    # load/main.py maps every field of the article record to a column of the
+    # articles table
+    check_fields(list(load.EXTRACTED_FIELDS), 'load/main.py')
+    columns = load.Article.__table__.columns.keys()
+    unknown = [column for column in load.EXTRACTED_FIELDS.values() if column not in columns]
+    if unknown:
+        raise SchemaError('load/article.py has no column for {}'.format(unknown))
+
+
+def _records_to_frame(records):
+    # pandas is left out of the startup, --help and a daemon waiting for
+    # its first round don't need it
+    import pandas as pd
+    # Empty strings are what read_csv turns into NaN on the CSV path
+    return pd.DataFrame([record.values() for record in records],
+                        columns=FIELDS).replace('', float('nan'))
+
+
+def _process_batch(news_site_uid, records, seen_titles, options):
+    with metrics.span('pipeline.batch', news_site_uid=news_site_uid, articles=len(records)):
+        return _transform_and_load(news_site_uid, records, seen_titles, options)
+
+
+def _transform_and_load(news_site_uid, records, seen_titles, options):
+    logger.info('Processing batch of {} articles for {}'.format(len(records), news_site_uid))
+    df = transform.transform(_records_to_frame(records),
+                             news_site_uid,
+                             options['engine'],
+                             options['workers'],
+                             options['memo'])
+    df = transform._remove_seen_entries(df, 'title_csv', seen_titles)
+    if options['near_duplicates']:
+        df = transform._flag_near_duplicates(df,
+                                             options['near_duplicates'],
+                                             options['near_duplicates_mode'])
+
+    if options['csv_dir']:
+        clean_filename = os.path.join(options['csv_dir'], 'clean_{}.csv'.format(news_site_uid))
+        transform._append_data(df, clean_filename)
+
+    load._load_articles(df.reset_index())
+    return len(df)
+
+
+async def _process_batch_in_thread(news_site_uid, records, seen_titles, options):
+    # Transformed and loaded in the thread of options while the event loop
+    # goes on fetching. The crawl index is only used from the event loop.
+    loop = asyncio.get_event_loop()
+    loaded = await loop.run_in_executor(
+        options['executor'],
+        functools.partial(contextvars.copy_context().run,
+                          _process_batch, news_site_uid, records, seen_titles, options))
+    # Every article of the batch is done with, loaded or dropped
+    if options['index']:
+        options['index'].checkpoint([record.url_csv for record in records])
+    return loaded
+
+
+def _options(csv_dir=None, engine='fast', workers=None, near_duplicates_mode=None,
+             similarity=0.8, use_index=True, use_memo=True):
+    options = {
+        'index': None,
+        'csv_dir': csv_dir,
+        'engine': engine,
+        'workers': workers,
+        'near_duplicates': None,
+        'near_duplicates_mode': near_duplicates_mode,
+        'memo': None,
+        # One thread, so batches never run at once: the memo, the near
+        # duplicate index and the titles seen are not shared between threads
+        'executor': concurrent.futures.ThreadPoolExecutor(max_workers=1),
+    }
+    if use_index:
+        options['index'] = extract.open_index(extract.config().get('crawl_index'))
+    if near_duplicates_mode:
+        options['near_duplicates'] = transform.NearDuplicateIndex(threshold=similarity)
+    if use_memo:
+        options['memo'] = transform.TokenMemo()
+    return options
+
+
+def _close_options(options):
+    options['executor'].shutdown()
+    metrics.export()
+    transform.shutdown_tokenizer_pool()
+    if options['index']:
+        options['index'].report()
+        options['index'].close()
+    if options['near_duplicates']:
+        options['near_duplicates'].close()
+    if options['memo']:
+        transform.report_memo(options['memo'])
+        options['memo'].close()
+
+
+async def _process_articles(articles, news_sites_selected, batch_size, options):
+    batches = {news_site_uid: [] for news_site_uid in news_sites_selected}
+    seen_titles = {news_site_uid: set() for news_site_uid in news_sites_selected}
+    loaded = {news_site_uid: 0 for news_site_uid in news_sites_selected}
+
+    async for news_site_uid, record in articles:
+        batch = batches[news_site_uid]
+        batch.append(record)
+        if len(batch) >= batch_size:
+            loaded[news_site_uid] += await _process_batch_in_thread(
+                news_site_uid, batch, seen_titles[news_site_uid], options)
+            batches[news_site_uid] = []
+
+    for news_site_uid, batch in batches.items():
+        if batch:
+            loaded[news_site_uid] += await _process_batch_in_thread(
+                news_site_uid, batch, seen_titles[news_site_uid], options)
+    return loaded
+
+
+async def run(news_sites_selected, batch_size=50, csv_dir=None, use_index=True,
+              engine='fast', workers=None, near_duplicates_mode=None, similarity=0.8,
+              use_memo=True):
+    _check_schema()
+    options = _options(csv_dir, engine, workers, near_duplicates_mode, similarity, use_index,
+                       use_memo)
+
+    load.ensure_schema()
+    try:
+        loaded = await _process_articles(
+            extract._scrape_articles(news_sites_selected, options['index']),
+            news_sites_selected, batch_size, options)
+    finally:
+        _close_options(options)
+
+    for news_site_uid, total in loaded.items():
+        logger.info('Loaded {} articles for {}'.format(total, news_site_uid))
+    return loaded
 
 
 def _main():
-    _extract()
-    # _transform()
-    # _load()
+    news_site_choices = list(extract.config()['news_sites'].keys())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l',
+                        '--names-list',
+                        nargs='+',
+                        help='The news sites list that you want to process',
+                        choices=news_site_choices,
+                        default=news_site_choices,)
+    parser.add_argument('-b',
+                        '--batch-size',
+                        help='Articles transformed and loaded at once',
+                        type=int,
+                        default=50)
+    parser.add_argument('-p',
+                        '--parse-workers',
+                        help='Parse pages in a pool of this many processes',
+                        type=int,
+                        default=None)
+    parser.add_argument('-e',
+                        '--engine',
+                        help='The implementation of the cleaning steps',
+                        choices=list(transform.ENGINES.keys()),
+                        default='fast')
+    parser.add_argument('-w',
+                        '--tokenize-workers',
+                        help='Tokenize in a pool of this many processes',
+                        type=int,
+                        default=None)
+    parser.add_argument('-d',
+                        '--near-duplicates',
+                        help='Flag articles similar to earlier ones, or drop them',
+                        choices=transform.near_duplicates_modes,
+                        default=None)
+    parser.add_argument('-s',
+                        '--similarity',
+                        help='Estimated Jaccard similarity of near duplicate bodies',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--csv-dir',
+                        help='Also write the clean CSV of each site in this folder',
+                        type=str,
+                        default=None)
+    parser.add_argument('--cache-mode',
+                        help='Cache responses on disk, or only replay the cached ones',
+                        choices=extract.response_cache.MODES,
+                        default=None)
+    parser.add_argument('--no-index',
+                        help='Fetch every article, even the ones crawled before',
+                        action='store_true')
+    parser.add_argument('--dataset',
+                        help='Also append the articles to the parquet dataset (needs pyarrow)',
+                        action='store_true')
+    parser.add_argument('--no-memo',
+                        help='Tokenize every text, even the ones counted in earlier runs',
+                        action='store_true')
+    args = parser.parse_args()
+    metrics.configure_from(extract.config().get('metrics'))
+    if args.parse_workers:
+        extract.news.use_process_pool(args.parse_workers)
+    if args.cache_mode:
+        extract.response_cache.use_cache_mode(args.cache_mode)
+    if args.dataset:
+        load.use_dataset()
+
+    logger.info('Starting pipeline for {}'.format(args.names_list))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.names_list,
+                                args.batch_size,
+                                args.csv_dir,
+                                not args.no_index,
+                                args.engine,
+                                args.tokenize_workers,
+                                args.near_duplicates,
+                                args.similarity,
+                                not args.no_memo))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,31 @@
+FIELDS = ('body_csv', 'fetched_at_csv', 'title_csv', 'url_csv')
+
+
+class SchemaError(Exception):
+    pass
+
+
+# The extracted strings of one article, the only thing kept from its page.
+# Every output file, the transform stage and load/main.py use these fields.
+class ArticleRecord:
+    __slots__ = FIELDS
+
+    def __init__(self, body_csv, fetched_at_csv, title_csv, url_csv):
+        self.body_csv = body_csv
+        self.fetched_at_csv = fetched_at_csv
+        self.title_csv = title_csv
+        self.url_csv = url_csv
+
+    def values(self):
+        return [getattr(self, field) for field in FIELDS]
+
+    def as_dict(self):
+        return dict(zip(FIELDS, self.values()))
+
+
+def check_fields(fields, source):
+    missing = [field for field in FIELDS if field not in fields]
+    unexpected = [field for field in fields if field not in FIELDS]
+    if missing or unexpected:
+        raise SchemaError('{} is out of sync with the article record, '
+                          'missing: {}, unexpected: {}'.format(source, missing, unexpected))
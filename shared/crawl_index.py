@@ -0,0 +1,157 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import logging
+logger = logging.getLogger("ws")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def url_uid(url):
+    # Same uid the transform stage gives every row, see _generate_uid_for_rows
+    return hashlib.md5(bytes(url.encode())).hexdigest()
+
+
+def content_hash(*fields):
+    return hashlib.md5(''.join(fields).encode()).hexdigest()
+
+
+# Persistent record of every article url crawled, with the validators needed
+# to re-check it with a conditional request. New or changed articles stay
+# pending until checkpoint() is called once they are saved, so a crawl that
+# is interrupted fetches them again instead of skipping them. Writes are
+# committed every 100 rows and on close, not one at a time.
+class CrawlIndex:
+    def __init__(self, path, recheck_after=None):
+        self._path = os.path.join(BASE_DIR, path)
+        self._recheck_after = recheck_after
+        # Shared by the workers of the job queue: readers don't wait for a
+        # writer, and a writer waits for another one instead of failing
+        self._connection = sqlite3.connect(self._path, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS crawled_urls (
+                uid TEXT PRIMARY KEY,
+                url TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                checked_at REAL
+            )''')
+        self._pending = {}
+        self._unsaved = 0
+        self.stats = {
+            'skipped': 0,
+            'not_modified': 0,
+            'unchanged': 0,
+            'fetched': 0,
+        }
+
+    def seed_from_db(self, db_path):
+        # Articles already loaded by earlier runs count as crawled
+        self._connection.execute('ATTACH DATABASE ? AS loaded', (db_path,))
+        cursor = self._connection.execute('''
+            INSERT OR IGNORE INTO crawled_urls (uid, url, checked_at)
+            SELECT id, url_csv, ? FROM loaded.articles''', (time.time(),))
+        self._connection.commit()
+        self._connection.execute('DETACH DATABASE loaded')
+        logger.info('Seeded crawl index with {} articles from {}'.format(
+            cursor.rowcount, db_path))
+
+    def get(self, url):
+        if url in self._pending:
+            return dict(zip(('etag', 'last_modified', 'content_hash', 'checked_at'),
+                            self._pending[url][2:]))
+        row = self._connection.execute(
+            'SELECT etag, last_modified, content_hash, checked_at '
+            'FROM crawled_urls WHERE uid = ?', (url_uid(url),)).fetchone()
+        if not row:
+            return None
+        return dict(zip(('etag', 'last_modified', 'content_hash', 'checked_at'), row))
+
+    def count(self):
+        return self._connection.execute('SELECT COUNT(*) FROM crawled_urls').fetchone()[0]
+
+    def urls(self):
+        return (url for url, in self._connection.execute('SELECT url FROM crawled_urls'))
+
+    def should_skip(self, url):
+        entry = self.get(url)
+        if not entry:
+            return False
+        if self._recheck_after is not None and \
+                time.time() - (entry['checked_at'] or 0) >= self._recheck_after:
+            return False
+        self.stats['skipped'] += 1
+        return True
+
+    def conditional_headers(self, url):
+        entry = self.get(url)
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def not_modified(self, url):
+        self.stats['not_modified'] += 1
+        self._connection.execute(
+            'UPDATE crawled_urls SET checked_at = ? WHERE uid = ?',
+            (time.time(), url_uid(url)))
+        self._commit_every(100)
+
+    # Returns False when the content is the same as the last time it was seen
+    def record(self, url, etag, last_modified, new_content_hash):
+        entry = self.get(url)
+        row = (url_uid(url), url, etag, last_modified, new_content_hash, time.time())
+
+        if entry and entry['content_hash'] == new_content_hash:
+            self.stats['unchanged'] += 1
+            self._write([row])
+            return False
+        self.stats['fetched'] += 1
+        self._pending[url] = row
+        return True
+
+    def checkpoint(self, urls):
+        self._write([self._pending.pop(url) for url in urls if url in self._pending])
+
+    def _write(self, rows):
+        self._connection.executemany('''
+            INSERT OR REPLACE INTO crawled_urls
+            (uid, url, etag, last_modified, content_hash, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        self._commit_every(100, len(rows))
+
+    def _commit_every(self, count, rows=1):
+        self._unsaved += rows
+        if self._unsaved >= count:
+            self.commit()
+
+    def report(self):
+        avoided = self.stats['skipped'] + self.stats['not_modified']
+        logger.info('Fetches avoided: {} (known {}, not modified {}), '
+                    'unchanged after fetch: {}, new or changed: {}'.format(
+                        avoided, self.stats['skipped'], self.stats['not_modified'],
+                        self.stats['unchanged'], self.stats['fetched']))
+        return avoided
+
+    def commit(self):
+        self._connection.commit()
+        self._unsaved = 0
+
+    def close(self):
+        if self._pending:
+            logger.info('{} fetched articles were not saved, '
+                        'they will be fetched again'.format(len(self._pending)))
+        self._connection.commit()
+        self._connection.close()
+
+
+def open_index(settings):
+    if not settings:
+        return None
+    return CrawlIndex(settings['path'], settings.get('recheck_after'))
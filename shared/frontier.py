@@ -0,0 +1,255 @@
+import fcntl
+import hashlib
+import heapq
+import itertools
+import math
+import os
+import re
+import struct
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+from common import config  # The config.yaml of the extractor running
+
+import logging
+logger = logging.getLogger("ws")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Query parameters that only track where a click came from
+tracking_parameter = re.compile(
+    r'^(utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|igshid|_ga)$', re.IGNORECASE)
+
+_DEFAULT_SETTINGS = {
+    'seen_path': '../seen_urls.bloom',
+    'capacity': 1000000,
+    'error_rate': 0.001,
+    'depth': 0,
+    'max_pages': 20,
+}
+
+__seen = None
+
+
+def frontier_settings(news_site_uid=None):
+    # The frontier section of config.yaml, with the overrides of a site
+    settings = dict(_DEFAULT_SETTINGS)
+    settings.update(config().get('frontier') or {})
+    if news_site_uid:
+        settings.update(config()['news_sites'][news_site_uid].get('frontier') or {})
+    return settings
+
+
+def _origin(host):
+    return host[4:] if host.startswith('www.') else host
+
+
+def _explicit_port(parts):
+    return None if parts.port in (None, DEFAULT_PORTS.get(parts.scheme.lower())) else parts.port
+
+
+def canonical_url(link, base_url, site_url=None):
+    # One spelling per page: scheme and host lowercased, default port,
+    # fragment and tracking parameters dropped, the other parameters sorted.
+    # Urls of the site's own host (with or without www.) take the scheme and
+    # host it is configured with, so http and https copies of a page are one
+    # url. Anything but http(s) gives None.
+    try:
+        parts = urlsplit(urljoin(base_url, link.strip()))
+        port = _explicit_port(parts)
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if scheme not in DEFAULT_PORTS or not host:
+        return None
+    netloc = host if port is None else '{}:{}'.format(host, port)
+    if site_url:
+        site = urlsplit(site_url)
+        if _origin(host) == _origin((site.hostname or '').lower()) and \
+                port == _explicit_port(site):
+            scheme, netloc = site.scheme.lower(), site.netloc.lower()
+
+    path = re.sub(r'/{2,}', '/', parts.path) or '/'
+    query = urlencode(sorted((name, value)
+                             for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not tracking_parameter.match(name)))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def url_key(url):
+    # The same page with and without a trailing slash
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=parts.path.rstrip('/') or '/'))
+
+
+# Bit array answering "maybe seen" or "surely not seen" for a url, about
+# 1.8MB for a million urls at a 0.1% error rate. Saved to a file between
+# runs, merged with what other processes saved meanwhile. indexed_rows is
+# how much of the crawl index it already holds.
+class BloomFilter:
+    _header = struct.Struct('<QQQQ')
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self.indexed_rows = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + position * second) % self.size for position in range(self.hashes)]
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def add(self, value):
+        added = False
+        for position in self._positions(value):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                self._bits[position >> 3] |= 1 << (position & 7)
+                added = True
+        if added:
+            self.count += 1
+
+    def _read(self, path):
+        with open(path, mode='rb') as file:
+            size, hashes, count, indexed_rows = self._header.unpack(
+                file.read(self._header.size))
+            bits = file.read()
+        if (size, hashes, len(bits)) != (self.size, self.hashes, len(self._bits)):
+            # Another capacity or error rate, its urls are looked up again
+            logger.warning('{} was built with other settings, starting a new one'.format(path))
+            return False
+        # One OR over the whole array as integers, not a byte at a time
+        merged = int.from_bytes(self._bits, 'little') | int.from_bytes(bits, 'little')
+        self._bits = bytearray(merged.to_bytes(len(self._bits), 'little'))
+        self.count = max(self.count, count)
+        self.indexed_rows = max(self.indexed_rows, indexed_rows)
+        return True
+
+    def save(self, path):
+        # Bits saved by other processes since this one loaded are kept, and
+        # the file is replaced in one step
+        with open('{}.lock'.format(path), mode='w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                self._read(path)
+            temporary = '{}.tmp'.format(path)
+            with open(temporary, mode='wb') as file:
+                file.write(self._header.pack(self.size, self.hashes, self.count,
+                                             self.indexed_rows))
+                file.write(self._bits)
+            os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, capacity=1000000, error_rate=0.001):
+        bloom = cls(capacity, error_rate)
+        if not os.path.exists(path) or not bloom._read(path):
+            return bloom
+        if bloom.count > bloom.capacity:
+            logger.warning('{} holds {} urls, over its capacity of {}'.format(
+                path, bloom.count, bloom.capacity))
+        return bloom
+
+
+def seen_urls(index):
+    # Every url of the crawl index is in the filter, so a url it has never
+    # seen can't be skipped and needs no lookup in the index
+    global __seen
+    if not __seen:
+        settings = frontier_settings()
+        __seen = BloomFilter.load(os.path.join(BASE_DIR, settings['seen_path']),
+                                  settings['capacity'],
+                                  settings['error_rate'])
+        rows = index.count()
+        if rows > __seen.indexed_rows:
+            logger.info('Adding the {} urls of the crawl index to the seen urls'.format(rows))
+            for url in index.urls():
+                __seen.add(url)
+            __seen.indexed_rows = rows
+
+    return __seen
+
+
+def save_seen_urls(index=None):
+    # Keeps the filter open, for crawls still adding to it
+    if __seen:
+        if index:
+            __seen.indexed_rows = index.count()
+        __seen.save(os.path.join(BASE_DIR, frontier_settings()['seen_path']))
+
+
+def close_seen_urls(index=None):
+    global __seen
+    save_seen_urls(index)
+    __seen = None
+
+
+# The listing pages of one site still to visit, and every url found on
+# them this round. The homepage and the sections of the site (its seeds)
+# come first, in their config order, then the pages they link to with
+# listing_links, up to depth hops away and max_pages pages in all. A page
+# linked with and without a trailing slash is found once, under the first
+# spelling, which is the one the site answers without a redirect.
+class Frontier:
+    def __init__(self, news_site_uid):
+        site = config()['news_sites'][news_site_uid]
+        settings = frontier_settings(news_site_uid)
+        self.site_url = site['url']
+        # Relative links of the homepage resolve under the site url, as if
+        # it ended in a slash, like the links of older crawls did
+        self._site_dir = self.site_url.rstrip('/') + '/'
+        self._home = canonical_url(self.site_url, self._site_dir, self.site_url)
+        self._host = urlsplit(self._home).netloc
+        self._depth = settings['depth']
+        self._max_pages = settings['max_pages']
+        self._pages = []
+        self._order = itertools.count()
+        self._found = set()
+        self.pages_visited = 0
+
+        for seed in [self.site_url] + list(settings.get('sections') or []):
+            self._add_page(self._canonical(seed, self._home), 0)
+
+    def _canonical(self, link, page_url):
+        return canonical_url(link, self._site_dir if page_url == self._home else page_url,
+                             self.site_url)
+
+    def _is_new(self, url):
+        if not url or url_key(url) in self._found:
+            return False
+        self._found.add(url_key(url))
+        return True
+
+    def _add_page(self, url, depth):
+        if self._is_new(url):
+            heapq.heappush(self._pages, (depth, next(self._order), url))
+
+    def next_page(self):
+        if not self._pages or self.pages_visited >= self._max_pages:
+            return None
+        depth, _, url = heapq.heappop(self._pages)
+        self.pages_visited += 1
+        return url, depth
+
+    def add_links(self, page_url, depth, article_links, listing_links=()):
+        # Returns the article urls not found before this round, in order
+        articles = []
+        for link in sorted(article_links):
+            url = self._canonical(link, page_url)
+            if self._is_new(url):
+                articles.append(url)
+        if depth < self._depth:
+            for link in sorted(listing_links):
+                url = self._canonical(link, page_url)
+                # Listings of other sites are never followed
+                if url and urlsplit(url).netloc == self._host:
+                    self._add_page(url, depth + 1)
+        return articles
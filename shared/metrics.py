@@ -0,0 +1,236 @@
+import bisect
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Used by every stage, which puts shared/ on sys.path before importing it,
+# so the pipeline's stages share one registry
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+__registry = None
+__settings = {'path': None, 'trace_path': None}
+__spans = []
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+# Cumulative counts per upper bound, plus the count and sum of every value
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            sample = self._values[key]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                sample['buckets'][position] += 1
+            sample['count'] += 1
+            sample['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, help_text, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, help_text, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help_text=''):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text=''):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets)
+
+    def metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+
+def registry():
+    global __registry
+    if not __registry:
+        __registry = Registry()
+    return __registry
+
+
+def counter(name, help_text=''):
+    return registry().counter(name, help_text)
+
+
+def gauge(name, help_text=''):
+    return registry().gauge(name, help_text)
+
+
+def histogram(name, help_text='', buckets=DEFAULT_BUCKETS):
+    return registry().histogram(name, help_text, buckets)
+
+
+def configure(path=None, trace_path=None):
+    # path ending in .json gets the JSON exporter, anything else the
+    # Prometheus text format. Spans are only kept when trace_path is set.
+    if path:
+        __settings['path'] = path
+    if trace_path:
+        __settings['trace_path'] = trace_path
+
+
+def configure_from(settings):
+    settings = settings or {}
+    configure(settings.get('path'), settings.get('trace_path'))
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    if not __settings['trace_path']:
+        yield
+        return
+    span_id = next(_span_ids)
+    token = _current_span.set(span_id)
+    start = time.time()
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        __spans.append({
+            'id': span_id,
+            'parent': _current_span.get(),
+            'name': name,
+            'start': start,
+            'duration': time.time() - start,
+            'attributes': {key: str(value) for key, value in attributes.items()},
+        })
+
+
+def _labels_text(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels))
+
+
+def prometheus_text(metrics):
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for key, value in metric.samples():
+            if metric.kind != 'histogram':
+                lines.append('{}{} {}'.format(metric.name, _labels_text(key), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name, _labels_text(key, [('le', str(bound))]), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                metric.name, _labels_text(key, [('le', '+Inf')]), value['count']))
+            lines.append('{}_sum{} {}'.format(metric.name, _labels_text(key), value['sum']))
+            lines.append('{}_count{} {}'.format(metric.name, _labels_text(key), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def json_text(metrics):
+    return json.dumps({metric.name: {
+        'type': metric.kind,
+        'help': metric.help,
+        'samples': [{'labels': dict(key), 'value': value} for key, value in metric.samples()],
+    } for metric in metrics}, indent=2)
+
+
+def _write(path, text):
+    # Replaced in one step, so a collector never reads half a file
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, mode='w') as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+def export():
+    path = __settings['path']
+    if path:
+        metrics = registry().metrics()
+        _write(path, json_text(metrics) if path.endswith('.json') else prometheus_text(metrics))
+        logger.info('Metrics written to {}'.format(path))
+
+    trace_path = __settings['trace_path']
+    if trace_path and __spans:
+        spans = list(__spans)
+        del __spans[:len(spans)]
+        with open(trace_path, mode='a') as file:
+            for finished in spans:
+                file.write(json.dumps(finished))
+                file.write('\n')
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from common import config  # The config.yaml of the extractor running
+
+import logging
+logger = logging.getLogger("ws")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ('off', 'on', 'replay')
+
+__cache = None
+
+
+class CacheMiss(Exception):
+    pass
+
+
+# Compressed response bodies stored by content hash under objects/, with an
+# sqlite index mapping every url to its body and validators. The least
+# recently used urls are evicted once the store grows past max_size_mb.
+# The sync extractor's fetch threads share it, so every call holds a lock.
+class ResponseCache:
+    def __init__(self, path, max_size_mb=500, default_ttl=3600, replay_only=False):
+        self._path = os.path.join(BASE_DIR, path)
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._default_ttl = default_ttl
+        self.replay_only = replay_only
+        os.makedirs(os.path.join(self._path, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(self._path, 'index.db'),
+                                           check_same_thread=False)
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                blob TEXT,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL,
+                accessed_at REAL
+            )''')
+        self._total_size = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM '
+            '(SELECT DISTINCT blob, size FROM responses)').fetchone()[0]
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def _blob_path(self, blob):
+        return os.path.join(self._path, 'objects', blob[:2], blob[2:])
+
+    def get(self, url, ttl=None):
+        with self._lock:
+            return self._get(url, ttl)
+
+    def _get(self, url, ttl):
+        row = self._connection.execute(
+            'SELECT blob, etag, last_modified, fetched_at FROM responses '
+            'WHERE url = ?', (url,)).fetchone()
+        ttl = self._default_ttl if ttl is None else ttl
+        fresh = row and (self.replay_only or time.time() - row[3] < ttl)
+        if not fresh:
+            self.stats['misses'] += 1
+            if self.replay_only:
+                raise CacheMiss('{} is not in the response cache'.format(url))
+            return None
+
+        blob, etag, last_modified, _ = row
+        try:
+            with open(self._blob_path(blob), mode='rb') as file:
+                text = zlib.decompress(file.read()).decode('utf-8')
+        except (OSError, zlib.error) as e:
+            logger.warning('ERROR reading cached {}: {}'.format(url, e))
+            self.stats['misses'] += 1
+            return None
+
+        self._connection.execute(
+            'UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        self._connection.commit()
+        self.stats['hits'] += 1
+        return text, etag, last_modified
+
+    def put(self, url, text, etag=None, last_modified=None):
+        with self._lock:
+            self._put(url, text, etag, last_modified)
+
+    def _put(self, url, text, etag, last_modified):
+        data = zlib.compress(text.encode('utf-8'))
+        blob = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(blob)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            with open(blob_path, mode='wb') as file:
+                file.write(data)
+            self._total_size += len(data)
+
+        previous = self._connection.execute(
+            'SELECT blob FROM responses WHERE url = ?', (url,)).fetchone()
+        now = time.time()
+        self._connection.execute('''
+            INSERT OR REPLACE INTO responses
+            (url, blob, size, etag, last_modified, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (url, blob, len(data), etag, last_modified, now, now))
+        if previous and previous[0] != blob:
+            self._release_blob(previous[0])
+        self._connection.commit()
+        self._evict()
+
+    def _release_blob(self, blob):
+        referenced = self._connection.execute(
+            'SELECT 1 FROM responses WHERE blob = ? LIMIT 1', (blob,)).fetchone()
+        if referenced:
+            return
+        blob_path = self._blob_path(blob)
+        if os.path.exists(blob_path):
+            self._total_size -= os.path.getsize(blob_path)
+            os.remove(blob_path)
+
+    def _evict(self):
+        if self._total_size <= self._max_size:
+            return
+        rows = self._connection.execute(
+            'SELECT url, blob FROM responses ORDER BY accessed_at').fetchall()
+        for url, blob in rows:
+            if self._total_size <= self._max_size:
+                break
+            self._connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self._release_blob(blob)
+            self.stats['evicted'] += 1
+        self._connection.commit()
+
+    def report(self):
+        logger.info('Response cache hits: {}, misses: {}, evicted: {}'.format(
+            self.stats['hits'], self.stats['misses'], self.stats['evicted']))
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+def _settings():
+    return config().get('response_cache') or {}
+
+
+def use_cache_mode(mode):
+    config().setdefault('response_cache', {})
+    config()['response_cache']['mode'] = mode
+
+
+def site_ttl(news_site_uid):
+    return config()['news_sites'][news_site_uid].get('cache_ttl')
+
+
+def cache():
+    global __cache
+    settings = _settings()
+    mode = settings.get('mode') or 'off'
+    if not __cache and mode != 'off':
+        __cache = ResponseCache(settings['path'],
+                                settings.get('max_size_mb', 500),
+                                settings.get('ttl', 3600),
+                                mode == 'replay')
+
+    return __cache
+
+
+def close_cache():
+    global __cache
+    if __cache:
+        __cache.report()
+        __cache.close()
+        __cache = None
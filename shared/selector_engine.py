@@ -0,0 +1,150 @@
+import bs4
+import soupsieve
+
+# Each backend parses a page once and runs the queries of a site, compiled
+# when the engine is built, returning the link hrefs or the article fields.
+# listing_links (optional) finds the section and pagination pages to crawl.
+# lxml and selectolax are optional and only imported when selected.
+BACKENDS = ('html.parser', 'lxml', 'selectolax')
+
+__engines = {}
+
+
+class SoupEngine:
+    def __init__(self, queries, features='html.parser'):
+        self._features = features
+        self._link_queries = [soupsieve.compile(query)
+                              for query in queries['homepage_article_links']]
+        self._listing_queries = [soupsieve.compile(query)
+                                 for query in queries.get('listing_links') or []]
+        self._body_query = soupsieve.compile(queries['article_body'])
+        self._title_query = soupsieve.compile(queries['article_title'])
+
+    def _parse(self, text):
+        return bs4.BeautifulSoup(text, self._features)
+
+    def _links(self, html, queries):
+        links = set()
+        for query in queries:
+            for link in query.select(html):
+                if link and link.has_attr('href'):
+                    links.add(link['href'])
+        return links
+
+    def article_links(self, text):
+        return self._links(self._parse(text), self._link_queries)
+
+    def page_links(self, text):
+        html = self._parse(text)
+        return {
+            'article_links': self._links(html, self._link_queries),
+            'listing_links': self._links(html, self._listing_queries),
+        }
+
+    def article_fields(self, text):
+        html = self._parse(text)
+        body = ''.join(result.text for result in self._body_query.select(html))
+        title = self._title_query.select_one(html)
+        return {
+            'body': body,
+            'title': title.text if title else '',
+        }
+
+
+class LxmlEngine:
+    def __init__(self, queries):
+        import lxml.html
+        from lxml.cssselect import CSSSelector
+
+        self._fromstring = lxml.html.fromstring
+        self._link_queries = [CSSSelector(query, translator='html')
+                              for query in queries['homepage_article_links']]
+        self._listing_queries = [CSSSelector(query, translator='html')
+                                 for query in queries.get('listing_links') or []]
+        self._body_query = CSSSelector(queries['article_body'], translator='html')
+        self._title_query = CSSSelector(queries['article_title'], translator='html')
+
+    def _links(self, html, queries):
+        links = set()
+        for query in queries:
+            for link in query(html):
+                if link.get('href') is not None:
+                    links.add(link.get('href'))
+        return links
+
+    def article_links(self, text):
+        return self._links(self._fromstring(text), self._link_queries)
+
+    def page_links(self, text):
+        html = self._fromstring(text)
+        return {
+            'article_links': self._links(html, self._link_queries),
+            'listing_links': self._links(html, self._listing_queries),
+        }
+
+    def article_fields(self, text):
+        html = self._fromstring(text)
+        body = ''.join(result.text_content() for result in self._body_query(html))
+        title = self._title_query(html)
+        return {
+            'body': body,
+            'title': title[0].text_content() if len(title) else '',
+        }
+
+
+class SelectolaxEngine:
+    def __init__(self, queries):
+        from selectolax.lexbor import LexborHTMLParser
+
+        # selectolax has no compiled selector objects, queries are kept as is
+        self._parser = LexborHTMLParser
+        self._link_queries = list(queries['homepage_article_links'])
+        self._listing_queries = list(queries.get('listing_links') or [])
+        self._body_query = queries['article_body']
+        self._title_query = queries['article_title']
+
+    def _links(self, html, queries):
+        links = set()
+        for query in queries:
+            for link in html.css(query):
+                if link.attributes.get('href') is not None:
+                    links.add(link.attributes['href'])
+        return links
+
+    def article_links(self, text):
+        return self._links(self._parser(text), self._link_queries)
+
+    def page_links(self, text):
+        html = self._parser(text)
+        return {
+            'article_links': self._links(html, self._link_queries),
+            'listing_links': self._links(html, self._listing_queries),
+        }
+
+    def article_fields(self, text):
+        html = self._parser(text)
+        body = ''.join(result.text() for result in html.css(self._body_query))
+        title = html.css_first(self._title_query)
+        return {
+            'body': body,
+            'title': title.text() if title else '',
+        }
+
+
+def build_engine(queries, backend='html.parser'):
+    if backend == 'html.parser':
+        return SoupEngine(queries)
+    elif backend == 'lxml':
+        return LxmlEngine(queries)
+    elif backend == 'selectolax':
+        return SelectolaxEngine(queries)
+    raise ValueError('Unknown parser backend {}, expected one of {}'.format(
+        backend, ', '.join(BACKENDS)))
+
+
+def engine(news_site_uid, queries, backend='html.parser'):
+    key = (news_site_uid, backend)
+    if key not in __engines:
+        __engines[key] = build_engine(queries, backend)
+
+    return __engines[key]
@@ -0,0 +1,162 @@
+import abc
+import csv
+import json
+import os
+
+from article_record import FIELDS, check_fields
+from common import config  # The config.yaml of the extractor running
+
+import logging
+logger = logging.getLogger("ws")
+
+# pyarrow is optional and only imported when parquet is selected.
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def output_settings():
+    settings = {'format': 'csv', 'row_group_size': 1000, 'flush_every': 50}
+    settings.update(config().get('output') or {})
+    return settings
+
+
+def use_output_format(output_format):
+    config().setdefault('output', {})
+    config()['output']['format'] = output_format
+
+
+# One open output file per site. on_flush gets the records once they are on
+# disk, a batch at a time.
+class Writer(abc.ABC):
+    extension = None
+
+    def __init__(self, base_name, on_flush=None):
+        self.path = '{}.{}'.format(base_name, self.extension)
+        self._on_flush = on_flush
+        self.rows = 0
+
+    def _flushed(self, records):
+        self.rows += len(records)
+        if self._on_flush and records:
+            self._on_flush(records)
+
+    @abc.abstractmethod
+    def write(self, record):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+# Text formats write every record as it arrives and flush the file every
+# flush_every records, so the crawl index commits once per batch
+class TextWriter(Writer):
+    def __init__(self, base_name, on_flush=None, flush_every=50):
+        super().__init__(base_name, on_flush)
+        self._flush_every = flush_every
+        self._unflushed = []
+        self._file = None
+
+    @abc.abstractmethod
+    def _write(self, record):
+        pass
+
+    def write(self, record):
+        self._write(record)
+        self._unflushed.append(record)
+        if len(self._unflushed) >= self._flush_every:
+            self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        records, self._unflushed = self._unflushed, []
+        self._flushed(records)
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+
+class CsvWriter(TextWriter):
+    extension = 'csv'
+
+    def __init__(self, base_name, on_flush=None, flush_every=50):
+        super().__init__(base_name, on_flush, flush_every)
+        # Appends, so a crawl that was interrupted carries on in the same file
+        self._is_new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+        self._file = open(self.path, mode='a')
+        self._writer = csv.writer(self._file)
+        if self._is_new:
+            self._writer.writerow(FIELDS)
+        else:
+            with open(self.path) as file:
+                check_fields(next(csv.reader(file)), self.path)
+
+    def _write(self, record):
+        self._writer.writerow(record.values())
+
+
+class JsonlWriter(TextWriter):
+    extension = 'jsonl'
+
+    def __init__(self, base_name, on_flush=None, flush_every=50):
+        super().__init__(base_name, on_flush, flush_every)
+        self._file = open(self.path, mode='a', encoding='utf-8')
+
+    def _write(self, record):
+        self._file.write(json.dumps(record.as_dict(), ensure_ascii=False))
+        self._file.write('\n')
+
+
+class ParquetWriter(Writer):
+    extension = 'parquet'
+
+    def __init__(self, base_name, on_flush=None, row_group_size=1000):
+        import pyarrow
+        import pyarrow.parquet
+
+        super().__init__(base_name, on_flush)
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        # A parquet file can't be appended to, a resumed crawl writes the next part
+        part = 0
+        while os.path.exists(self.path):
+            part += 1
+            self.path = '{}_{}.{}'.format(base_name, part, self.extension)
+        self._row_group_size = row_group_size
+        self._buffer = []
+        self._schema = pyarrow.schema([(field, pyarrow.string()) for field in FIELDS])
+        self._writer = None
+
+    def write(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        if self._writer is None:
+            self._writer = self._parquet.ParquetWriter(self.path, self._schema)
+        columns = [[getattr(record, field) for record in self._buffer] for field in FIELDS]
+        self._writer.write_table(
+            self._pyarrow.Table.from_arrays(columns, schema=self._schema))
+        records, self._buffer = self._buffer, []
+        self._flushed(records)
+
+    def close(self):
+        self._flush()
+        if self._writer:
+            self._writer.close()
+
+
+def open_writer(base_name, on_flush=None, output_format=None):
+    settings = output_settings()
+    output_format = output_format or settings['format']
+    if output_format == 'csv':
+        return CsvWriter(base_name, on_flush, settings['flush_every'])
+    if output_format == 'jsonl':
+        return JsonlWriter(base_name, on_flush, settings['flush_every'])
+    if output_format == 'parquet':
+        return ParquetWriter(base_name, on_flush, settings['row_group_size'])
+    raise ValueError('Unknown output format {}, use one of {}'.format(output_format, FORMATS))
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+from crawl_index import CrawlIndex, content_hash  # noqa: E402
+
+URL = 'https://www.example.com/news/1'
+
+
+def _record(index, body='body'):
+    return index.record(URL, '"v1"', 'Mon, 18 Mar 2019 10:00:00 GMT',
+                        content_hash('title', body))
+
+
+def test_new_article_is_pending_until_checkpoint(tmp_path):
+    path = str(tmp_path / 'crawl_index.db')
+    index = CrawlIndex(path)
+    assert not index.should_skip(URL)
+    assert _record(index)
+    # Known to this crawl, but not saved for the next one
+    assert index.should_skip(URL)
+    index.close()
+
+    index = CrawlIndex(path)
+    assert not index.should_skip(URL)
+    assert _record(index)
+    index.checkpoint([URL])
+    index.close()
+
+    index = CrawlIndex(path)
+    assert index.should_skip(URL)
+    assert index.count() == 1
+    assert list(index.urls()) == [URL]
+    index.close()
+
+
+def test_unchanged_content_is_not_fetched_again(tmp_path):
+    index = CrawlIndex(str(tmp_path / 'crawl_index.db'))
+    _record(index)
+    index.checkpoint([URL])
+    assert not _record(index)
+    assert _record(index, body='corrected body')
+    assert index.stats['unchanged'] == 1
+    assert index.stats['fetched'] == 2
+    index.close()
+
+
+def test_conditional_headers_use_the_saved_validators(tmp_path):
+    index = CrawlIndex(str(tmp_path / 'crawl_index.db'))
+    assert index.conditional_headers(URL) == {}
+    _record(index)
+    index.checkpoint([URL])
+    assert index.conditional_headers(URL) == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Mon, 18 Mar 2019 10:00:00 GMT',
+    }
+    index.close()
+
+
+def test_recheck_after_expires_the_skip(tmp_path):
+    path = str(tmp_path / 'crawl_index.db')
+    index = CrawlIndex(path, recheck_after=3600)
+    _record(index)
+    index.checkpoint([URL])
+    assert index.should_skip(URL)
+    index.close()
+
+    index = CrawlIndex(path, recheck_after=0)
+    assert not index.should_skip(URL)
+    before = time.time()
+    index.not_modified(URL)
+    assert index.get(URL)['checked_at'] >= before
+    assert index.stats == {'skipped': 0, 'not_modified': 1, 'unchanged': 0, 'fetched': 0}
+    index.close()
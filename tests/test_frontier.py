@@ -0,0 +1,81 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/, with the config of the async extractor
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'extract-async'))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+from frontier import BloomFilter, canonical_url, url_key  # noqa: E402
+
+SITE_URL = 'https://www.example.com'
+
+
+def test_canonical_url_drops_tracking_parameters():
+    url = canonical_url('/news/1?utm_source=tw&b=2&fbclid=x&a=1&GCLID=y#comments',
+                        SITE_URL, SITE_URL)
+    assert url == 'https://www.example.com/news/1?a=1&b=2'
+
+
+def test_canonical_url_drops_default_ports_only():
+    assert canonical_url('https://www.example.com:443/news/1', SITE_URL, SITE_URL) == \
+        'https://www.example.com/news/1'
+    assert canonical_url('http://other.com:80/news/1', SITE_URL, SITE_URL) == \
+        'http://other.com/news/1'
+    assert canonical_url('http://other.com:8080/news/1', SITE_URL, SITE_URL) == \
+        'http://other.com:8080/news/1'
+
+
+def test_canonical_url_gives_the_site_its_configured_host():
+    for link in ('http://example.com/news/1',
+                 'https://EXAMPLE.com/news/1',
+                 'http://www.example.com/news/1'):
+        assert canonical_url(link, SITE_URL, SITE_URL) == 'https://www.example.com/news/1'
+    # Another port is another site
+    assert canonical_url('http://example.com:8080/news/1', SITE_URL, SITE_URL) == \
+        'http://example.com:8080/news/1'
+
+
+def test_canonical_url_rejects_other_schemes():
+    assert canonical_url('mailto:news@example.com', SITE_URL, SITE_URL) is None
+    assert canonical_url('javascript:void(0)', SITE_URL, SITE_URL) is None
+
+
+def test_url_key_ignores_trailing_slash():
+    with_slash = canonical_url('/sec/', SITE_URL, SITE_URL)
+    without_slash = canonical_url('/sec', SITE_URL, SITE_URL)
+    # Each spelling is kept, the site may only answer one without a redirect
+    assert with_slash != without_slash
+    assert url_key(with_slash) == url_key(without_slash)
+    assert url_key(canonical_url('/', SITE_URL, SITE_URL)) == 'https://www.example.com/'
+
+
+def test_bloom_filter_save_keeps_the_urls_of_other_processes(tmp_path):
+    path = str(tmp_path / 'seen_urls.bloom')
+    first = BloomFilter.load(path, capacity=1000)
+    second = BloomFilter.load(path, capacity=1000)
+    first.add('https://www.example.com/a')
+    second.add('https://www.example.com/b')
+    first.indexed_rows = 5
+
+    first.save(path)
+    second.save(path)
+
+    merged = BloomFilter.load(path, capacity=1000)
+    assert 'https://www.example.com/a' in merged
+    assert 'https://www.example.com/b' in merged
+    assert 'https://www.example.com/c' not in merged
+    assert merged.indexed_rows == 5
+    # The second one merged what the first saved before writing
+    assert 'https://www.example.com/a' in second
+
+
+def test_bloom_filter_with_other_settings_starts_over(tmp_path):
+    path = str(tmp_path / 'seen_urls.bloom')
+    bloom = BloomFilter(capacity=1000)
+    bloom.add('https://www.example.com/a')
+    bloom.save(path)
+
+    other = BloomFilter.load(path, capacity=100000)
+    assert 'https://www.example.com/a' not in other
+    assert other.count == 0
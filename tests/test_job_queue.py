@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The job queue is part of the async extractor, the modules it shares are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'extract-async'))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import pytest  # noqa: E402
+
+from job_queue import JobQueue  # noqa: E402
+
+HOMEPAGE = 'https://www.example.com/'
+ARTICLE = 'https://www.example.com/news/1'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Leases and retries are decided by time.time(), moved by hand here
+    now = [1000000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'job_queue.db'), lease_seconds=120,
+                     max_attempts=3, retry_after=30)
+    yield queue
+    queue.close()
+
+
+def test_host_is_leased_to_one_worker(queue, clock):
+    queue.add_homepage('example', HOMEPAGE)
+    queue.add_articles('example', [ARTICLE])
+
+    jobs = queue.claim('worker-1')
+    assert [job['url'] for job in jobs] == [HOMEPAGE, ARTICLE]
+    assert all(job['attempts'] == 1 for job in jobs)
+    assert queue.claim('worker-2') == []
+    assert queue.counts()['leased'] == 2
+
+
+def test_expired_lease_goes_to_another_worker(queue, clock):
+    queue.add_articles('example', [ARTICLE])
+    queue.claim('worker-1')
+
+    clock[0] += 60
+    queue.renew('worker-1')
+    clock[0] += 119
+    assert queue.claim('worker-2') == []
+
+    # worker-1 died, its lease runs out
+    clock[0] += 2
+    jobs = queue.claim('worker-2')
+    assert [(job['url'], job['attempts']) for job in jobs] == [(ARTICLE, 2)]
+
+
+def test_failed_job_is_retried_with_backoff(queue, clock):
+    queue.add_articles('example', [ARTICLE])
+
+    job, = queue.claim('worker-1')
+    assert queue.retry(job['id'], job['attempts'], 'timeout')
+    clock[0] += 29
+    assert queue.claim('worker-1') == []
+    clock[0] += 1
+    job, = queue.claim('worker-1')
+    assert job['attempts'] == 2
+
+    # Twice as long after the second attempt
+    assert queue.retry(job['id'], job['attempts'], 'timeout')
+    clock[0] += 59
+    assert queue.claim('worker-1') == []
+    clock[0] += 1
+    job, = queue.claim('worker-1')
+    assert job['attempts'] == 3
+
+    assert not queue.retry(job['id'], job['attempts'], 'timeout')
+    clock[0] += 3600
+    assert queue.claim('worker-1') == []
+    assert queue.counts()['failed'] == 1
+    assert queue.is_idle()
+
+
+def test_released_jobs_keep_their_attempts(queue, clock):
+    queue.add_articles('example', [ARTICLE])
+    queue.claim('worker-1')
+    queue.release('worker-1')
+
+    job, = queue.claim('worker-2')
+    assert job['attempts'] == 1
+
+
+def test_failed_job_added_again_starts_over(queue, clock):
+    queue.add_articles('example', [ARTICLE])
+    for _ in range(3):
+        job, = queue.claim('worker-1')
+        queue.retry(job['id'], job['attempts'], 'timeout')
+        clock[0] += 3600
+    assert queue.counts()['failed'] == 1
+
+    queue.add_articles('example', [ARTICLE])
+    job, = queue.claim('worker-1')
+    assert job['attempts'] == 1
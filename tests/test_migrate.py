@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'load'))
+# base.py opens the database named here when it is imported
+os.environ['NEWSPAPER_DB'] = os.path.join(tempfile.mkdtemp(), 'newspaper.db')
+
+import pytest  # noqa: E402
+
+from base import db_path  # noqa: E402
+from migrate import MIGRATIONS, ensure_schema  # noqa: E402
+from search import FTS_TABLE, search  # noqa: E402
+
+# The articles table as the first version of load/main.py created it
+VERSION_0 = '''
+    CREATE TABLE articles (
+        id VARCHAR NOT NULL,
+        body_csv VARCHAR,
+        host VARCHAR,
+        title_csv VARCHAR,
+        newspapper_uid VARCHAR,
+        n_token_body_csv VARCHAR,
+        n_token_title_csv VARCHAR,
+        url_csv VARCHAR,
+        PRIMARY KEY (id),
+        UNIQUE (url_csv)
+    )'''
+
+ARTICLES = [
+    ('a1', 'El congreso aprobó la reforma electoral', 'www.eluniversal.com.mx',
+     'Aprueban reforma', 'eluniversal', '6', '2', 'https://www.eluniversal.com.mx/a1'),
+    ('a2', 'Lluvias en la Ciudad de México', 'www.eluniversal.com.mx',
+     'Pronóstico del clima', 'eluniversal', '6', '3', 'https://www.eluniversal.com.mx/a2'),
+]
+
+
+def _connect():
+    return sqlite3.connect(db_path)
+
+
+@pytest.fixture
+def version_0_db():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    connection = _connect()
+    connection.execute(VERSION_0)
+    connection.executemany('INSERT INTO articles VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ARTICLES)
+    connection.commit()
+    connection.close()
+
+
+def _snapshot():
+    connection = _connect()
+    rows = connection.execute('''
+        SELECT id, n_token_body_csv, n_token_title_csv, body_hash
+        FROM articles ORDER BY id''').fetchall()
+    indexed = connection.execute(
+        'SELECT article_id FROM {} ORDER BY article_id'.format(FTS_TABLE)).fetchall()
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    connection.close()
+    return rows, indexed, version
+
+
+def test_version_0_is_migrated_to_the_current_schema(version_0_db):
+    ensure_schema()
+    rows, indexed, version = _snapshot()
+
+    assert version == len(MIGRATIONS) == 3
+    assert rows == [(article[0], int(article[5]), int(article[6]),
+                     hashlib.md5(article[1].encode()).hexdigest()) for article in ARTICLES]
+    assert indexed == [('a1',), ('a2',)]
+    assert [result['id'] for result in search('reforma')] == ['a1']
+    # Accents are folded on both sides
+    assert [result['id'] for result in search('mexico')] == ['a2']
+
+    connection = _connect()
+    tables = {name for name, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    indexes = {name for name, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    connection.close()
+    assert 'articles_v0' not in tables
+    assert {'ix_articles_host', 'ix_articles_fetched_at',
+            'ix_articles_newspapper_uid_fetched_at'} <= indexes
+
+
+def test_migrating_again_changes_nothing(version_0_db):
+    ensure_schema()
+    migrated = _snapshot()
+    ensure_schema()
+    assert _snapshot() == migrated
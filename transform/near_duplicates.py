@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sqlite3
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ('flag', 'drop')
+
+# Universal hashing modulo a Mersenne prime keeps every product of a 31 bit
+# coefficient and a 32 bit shingle hash inside uint64
+_PRIME = (1 << 31) - 1
+
+
+def _band_layout(num_perm, threshold):
+    # The bands x rows split whose similarity threshold, (1/b)^(1/r), is the
+    # closest to the one asked for
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        error = abs((1.0 / bands) ** (1.0 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+def _hash(value, digest_size):
+    return int.from_bytes(hashlib.blake2b(value, digest_size=digest_size).digest(),
+                          'little', signed=digest_size == 8)
+
+
+# MinHash signatures of the body shingles of every article seen, with an LSH
+# index of their bands, stored in sqlite so it is kept between runs. Only
+# articles sharing a band bucket are compared, so checking a new article
+# doesn't depend on how many were indexed before.
+class NearDuplicateIndex:
+    def __init__(self, path='near_duplicates.db', threshold=0.8, num_perm=128,
+                 shingle_size=3, seed=1):
+        self._threshold = threshold
+        self._num_perm = num_perm
+        self._shingle_size = shingle_size
+        self._bands, self._rows = _band_layout(num_perm, threshold)
+        # Only imported once near duplicates are turned on
+        import numpy as np
+        self._np = np
+        random = np.random.RandomState(seed)
+        self._a = random.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self._b = random.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+        # The pipeline uses it from the thread it transforms batches in, one
+        # batch at a time
+        self._connection = sqlite3.connect(os.path.join(BASE_DIR, path),
+                                           check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS signatures (
+                uid TEXT PRIMARY KEY,
+                newspapper_uid TEXT,
+                signature BLOB,
+                duplicate_of TEXT
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                band INTEGER,
+                bucket INTEGER,
+                uid TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ix_buckets_band_bucket ON buckets (band, bucket);
+        ''')
+        self._check_settings({'num_perm': num_perm,
+                              'shingle_size': shingle_size,
+                              'seed': seed})
+        self._check_bands()
+        self.stats = {'checked': 0, 'duplicates': 0}
+
+    def _check_settings(self, settings):
+        # Signatures built with other parameters can't be compared
+        for name, value in settings.items():
+            stored = self._connection.execute(
+                'SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+            if stored is None:
+                self._connection.execute(
+                    'INSERT INTO settings (name, value) VALUES (?, ?)', (name, str(value)))
+            elif stored[0] != str(value):
+                raise ValueError(
+                    'The near duplicates index was built with {}={}, not {}'.format(
+                        name, stored[0], value))
+        self._connection.commit()
+
+    def _check_bands(self):
+        # Another similarity threshold only changes the bands, the buckets
+        # are rebuilt from the stored signatures
+        np = self._np
+        stored = self._connection.execute(
+            "SELECT value FROM settings WHERE name = 'bands'").fetchone()
+        if stored and stored[0] == str(self._bands):
+            return
+        self._connection.execute('DELETE FROM buckets')
+        for uid, signature in self._connection.execute(
+                'SELECT uid, signature FROM signatures').fetchall():
+            self._connection.executemany(
+                'INSERT INTO buckets (band, bucket, uid) VALUES (?, ?, ?)',
+                [(band, bucket, uid) for band, bucket in self._band_buckets(
+                    np.frombuffer(signature, dtype=np.uint64))])
+        self._connection.execute(
+            'INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+            ('bands', str(self._bands)))
+        self._connection.commit()
+
+    def signature(self, tokens):
+        np = self._np
+        size = self._shingle_size
+        shingles = set(' '.join(tokens[start:start + size])
+                       for start in range(max(1, len(tokens) - size + 1)))
+        hashes = np.fromiter((_hash(shingle.encode(), 4) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def _band_buckets(self, signature):
+        for band in range(self._bands):
+            rows = signature[band * self._rows:(band + 1) * self._rows]
+            yield band, _hash(rows.tobytes(), 8)
+
+    def _best_match(self, signature):
+        np = self._np
+        candidates = set()
+        for band, bucket in self._band_buckets(signature):
+            candidates.update(uid for uid, in self._connection.execute(
+                'SELECT uid FROM buckets WHERE band = ? AND bucket = ?', (band, bucket)))
+
+        best_uid, best_similarity, best_root = None, 0.0, None
+        for uid in candidates:
+            stored, duplicate_of = self._connection.execute(
+                'SELECT signature, duplicate_of FROM signatures WHERE uid = ?',
+                (uid,)).fetchone()
+            similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint64) == signature))
+            if similarity >= self._threshold and similarity > best_similarity:
+                best_uid, best_similarity, best_root = uid, similarity, duplicate_of
+        # Duplicates of a duplicate point at the first article of the cluster
+        return best_root or best_uid
+
+    def known(self, uids):
+        # The uids checked before, whose tokens check() doesn't need
+        uids = list(uids)
+        found = set()
+        for start in range(0, len(uids), 500):
+            batch = uids[start:start + 500]
+            found.update(uid for uid, in self._connection.execute(
+                'SELECT uid FROM signatures WHERE uid IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+        return found
+
+    # Returns the uid of the earlier article this one duplicates, or None
+    def check(self, uid, newspapper_uid, tokens):
+        self.stats['checked'] += 1
+        known = self._connection.execute(
+            'SELECT duplicate_of FROM signatures WHERE uid = ?', (uid,)).fetchone()
+        if known:
+            duplicate_of = known[0]
+        elif not tokens:
+            return None
+        else:
+            signature = self.signature(tokens)
+            duplicate_of = self._best_match(signature)
+            self._connection.execute(
+                'INSERT INTO signatures (uid, newspapper_uid, signature, duplicate_of) '
+                'VALUES (?, ?, ?, ?)',
+                (uid, newspapper_uid, signature.tobytes(), duplicate_of))
+            self._connection.executemany(
+                'INSERT INTO buckets (band, bucket, uid) VALUES (?, ?, ?)',
+                [(band, bucket, uid) for band, bucket in self._band_buckets(signature)])
+
+        if duplicate_of:
+            self.stats['duplicates'] += 1
+        return duplicate_of
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
@@ -1,12 +1,20 @@
 import argparse
+import concurrent.futures
+import math
+import os
 from urllib.parse import urlparse
-import pandas as pd
 import hashlib
 import re
-import nltk
-# nltk.download('punkt')
-# nltk.download('stopwords')
-from nltk.corpus import stopwords
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules every stage uses are in shared/
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'shared'))
+
+import metrics  # noqa: E402
+from near_duplicates import MODES as near_duplicates_modes, NearDuplicateIndex  # noqa: E402
+from token_memo import TokenMemo, text_key  # noqa: E402
 
 # Logger
 import logging
@@ -14,6 +22,22 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# pandas and nltk take most of the startup time, so they're imported by the
+# functions that use them: --help, the search CLI and the pipeline's startup
+# don't pay for them, and the nltk corpora load on the first tokenized text.
+# nltk.download('punkt')
+# nltk.download('stopwords')
+
+step_rows = metrics.counter('transform_step_rows', 'Rows that went through each transform step')
+step_seconds = metrics.counter('transform_step_seconds', 'Seconds spent in each transform step')
+memo_lookups = metrics.counter('transform_memo_lookups',
+                               'Texts whose token count was looked up in the memo, per outcome')
+
+# What the token counts depend on besides the stop words, a change here
+# makes the memo drop the counts it holds
+TOKENIZER_SETTINGS = 'nltk.word_tokenize, alphabetic tokens, lowercased, spanish stop words'
+
+
 def _log(message, logger_type=None):
     if logger_type == 'info':
         return logger.info(message)
@@ -21,17 +45,27 @@ def _log(message, logger_type=None):
         return logger.info(message)
 
 
-def _get_args(name, help, type):
-    parser = argparse.ArgumentParser()
-    parser.add_argument(name,
-                        help=help,
-                        type=type)
-    return parser.parse_args()
+def _timed_step(step, function, df, *args):
+    start = time.perf_counter()
+    with metrics.span('transform.{}'.format(step), rows=len(df)):
+        result = function(df, *args)
+    step_seconds.inc(time.perf_counter() - start, step=step)
+    step_rows.inc(len(df), step=step)
+    return result
+
+
+def _report_steps():
+    rows = dict(step_rows.samples())
+    for key, seconds in step_seconds.samples():
+        _log('{}: {} rows in {:.3f}s ({:.0f} rows/sec)'.format(
+            dict(key)['step'], rows.get(key, 0), seconds,
+            rows.get(key, 0) / seconds if seconds else 0))
 
 
 def _read_data(filename, encoding):
+    import pandas as pd
     _log('Reading file {}'.format(filename))
-    return pd.read_csv(filename, encoding, delimiter=',', engine='python')
+    return pd.read_csv(filename, encoding=encoding, delimiter=',', engine='python')
 
 
 def _extract_newspapper_uid(filename):
@@ -90,7 +124,7 @@ def _remove_unwanted_chars(df, replacements):
 def _tokenize_column(df, column_name, stop_words):
     return (df
             .dropna()
-            .apply(lambda row: nltk.word_tokenize(row[column_name]), axis=1)
+            .apply(lambda row: _word_tokenize(row[column_name]), axis=1)
             .apply(lambda tokens: list(filter(lambda token: token.isalpha(), tokens)))
             .apply(lambda tokens: list(map(lambda token: token.lower(), tokens)))
             .apply(lambda word_list: list(filter(lambda word: word not in stop_words, word_list)))
@@ -105,6 +139,191 @@ def _tokenize_columns(df, columns, stop_words):
     return df
 
 
+# Fast engine: the same steps without row-wise apply, producing exactly the
+# same output as the ones above
+def _extract_host_fast(df):
+    _log('Extracting host from urls')
+    hosts = {url: urlparse(url).netloc for url in df['url_csv'].unique()}
+    df['host'] = df['url_csv'].map(hosts)
+    return df
+
+
+def _fill_missing_titles_fast(df):
+    _log('Filling missing titles')
+    missing_title_mask = df['title_csv'].isna()
+    missing_title = (df.loc[missing_title_mask, 'url_csv']
+                     .str.extract(r'(?P<missin_titles>[^/]+)$', expand=False)
+                     .str.replace('-', ' ', regex=False)
+                     )
+    df.loc[missing_title_mask, 'title_csv'] = missing_title
+    return df
+
+
+def _generate_uid_for_rows_fast(df):
+    _log('Generating UID for each row of the DataFrame')
+    md5 = hashlib.md5
+    df['uid'] = [md5(url.encode()).hexdigest() for url in df['url_csv']]
+    return df.set_index('uid')
+
+
+def _remove_unwanted_chars_fast(df, replacements):
+    _log('Removing unwanted (replacements) chars')
+    df['body_csv'] = df['body_csv'].str.translate(str.maketrans(replacements))
+    return df
+
+
+def _word_tokenize(text):
+    import nltk
+    return nltk.word_tokenize(text)
+
+
+def _valid_tokens(text, stop_words):
+    for token in _word_tokenize(text):
+        if token.isalpha():
+            token = token.lower()
+            if token not in stop_words:
+                yield token
+
+
+def _count_tokens(text, stop_words):
+    count = 0
+    for _ in _valid_tokens(text, stop_words):
+        count += 1
+    return count
+
+
+def _tokenize_columns_fast(df, columns, stop_words):
+    _log('Tokenazing columns')
+    # Only rows without missing values are counted, as dropna() does above
+    complete_rows = df.notna().all(axis=1)
+    for column in columns:
+        df['n_token_' + column] = (df.loc[complete_rows, column]
+                                   .map(lambda text: _count_tokens(text, stop_words)))
+    return df
+
+
+__tokenizer_pool = None
+__tokenizer_workers = None
+__worker_stop_words = None
+
+
+def _init_tokenizer_worker():
+    # Loaded once per worker process instead of once per chunk
+    global __worker_stop_words
+    __worker_stop_words = _stop_words()
+    _word_tokenize('punkt')
+
+
+def _count_tokens_chunk(rows):
+    return [tuple(_count_tokens(text, __worker_stop_words) for text in row)
+            for row in rows]
+
+
+def _tokenizer_pool(workers):
+    # Started again when asked for another number of workers
+    global __tokenizer_pool, __tokenizer_workers
+    if __tokenizer_pool and __tokenizer_workers != workers:
+        shutdown_tokenizer_pool()
+    if not __tokenizer_pool:
+        __tokenizer_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_tokenizer_worker)
+        __tokenizer_workers = workers
+
+    return __tokenizer_pool
+
+
+def shutdown_tokenizer_pool():
+    global __tokenizer_pool, __tokenizer_workers
+    if __tokenizer_pool:
+        __tokenizer_pool.shutdown()
+        __tokenizer_pool = None
+        __tokenizer_workers = None
+
+
+def _tokenize_columns_parallel(df, columns, workers):
+    import pandas as pd
+    _log('Tokenazing columns with {} workers'.format(workers))
+    complete_rows = df.notna().all(axis=1)
+    rows = list(zip(*[df.loc[complete_rows, column] for column in columns]))
+    chunk_size = max(1, math.ceil(len(rows) / (workers * 4)))
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+
+    # map() hands the chunks back in order, so counts line up with the rows
+    counts = []
+    for chunk_counts in _tokenizer_pool(workers).map(_count_tokens_chunk, chunks):
+        counts.extend(chunk_counts)
+
+    index = df.index[complete_rows]
+    for position, column in enumerate(columns):
+        df['n_token_' + column] = pd.Series([count[position] for count in counts],
+                                            index=index, dtype='int64')
+    return df
+
+
+def _tokenizer_version():
+    import nltk
+    settings = '\n'.join([nltk.__version__, TOKENIZER_SETTINGS] + sorted(_stop_words()))
+    return hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+
+
+def _tokenize_columns_memoized(df, columns, memo, tokenize_columns, *args):
+    import pandas as pd
+    _log('Looking up token counts in the memo')
+    memo.set_version(_tokenizer_version())
+    # The same rows the tokenizers count, the others get NaN like theirs do
+    complete_rows = df.notna().all(axis=1).tolist()
+    keys = {column: [text_key(text) if complete else None
+                     for text, complete in zip(df[column], complete_rows)]
+            for column in columns}
+    counts = memo.get_many(set(key for column in columns for key in keys[column]
+                               if key is not None))
+    missing = [position for position, complete in enumerate(complete_rows)
+               if complete and any(keys[column][position] not in counts for column in columns)]
+
+    looked_up = sum(complete_rows) * len(columns)
+    hits = looked_up - sum(keys[column][position] not in counts
+                           for position in missing for column in columns)
+    memo.stats['hits'] += hits
+    memo.stats['misses'] += looked_up - hits
+    memo_lookups.inc(hits, outcome='hit')
+    memo_lookups.inc(looked_up - hits, outcome='miss')
+
+    # Only the rows with a text never seen before are tokenized
+    if missing:
+        tokenized = tokenize_columns(df.iloc[missing].copy(), columns, *args)
+        new_counts = {}
+        for column in columns:
+            new_counts.update(zip([keys[column][position] for position in missing],
+                                  tokenized['n_token_' + column].astype('int64').tolist()))
+        memo.put_many(new_counts)
+        counts.update(new_counts)
+    memo.commit()
+
+    for column in columns:
+        df['n_token_' + column] = pd.Series(
+            [counts[key] if key is not None else float('nan') for key in keys[column]],
+            index=df.index)
+    return df
+
+
+ENGINES = {
+    'default': {
+        'extract_host': _extract_host,
+        'fill_missing_titles': _fill_missing_titles,
+        'generate_uid_for_rows': _generate_uid_for_rows,
+        'remove_unwanted_chars': _remove_unwanted_chars,
+        'tokenize_columns': _tokenize_columns,
+    },
+    'fast': {
+        'extract_host': _extract_host_fast,
+        'fill_missing_titles': _fill_missing_titles_fast,
+        'generate_uid_for_rows': _generate_uid_for_rows_fast,
+        'remove_unwanted_chars': _remove_unwanted_chars_fast,
+        'tokenize_columns': _tokenize_columns_fast,
+    },
+}
+
+
 def _remove_duplicate_entries(df, column_name):
     _log('Removing Duplicate Entries')
     df.drop_duplicates(subset=[column_name], keep='first', inplace=True)
@@ -126,25 +345,159 @@ def _save_data(df, filename):
     df.to_csv(clean_filename, encoding='utf-8-sig')
 
 
-def main(filename):
-    _log('Starting cleaning process')
-    df = _read_data(filename, 'ISO-8859-1')
-    newspapper_uid = _extract_newspapper_uid(filename)
-    df = _add_newspapper_uid_column(df, newspapper_uid)
-    df = _extract_host(df)
-    df = _fill_missing_titles(df)
-    df = _generate_uid_for_rows(df)
+def _append_data(df, filename):
+    _log('Appending data at location: {}'.format(filename))
+    if os.path.exists(filename):
+        df.to_csv(filename, mode='a', header=False, encoding='utf-8')
+    else:
+        df.to_csv(filename, encoding='utf-8-sig')
+
+
+__stop_words = None
+
+
+def _stop_words():
+    global __stop_words
+    if not __stop_words:
+        from nltk.corpus import stopwords
+        __stop_words = set(stopwords.words('spanish'))
+
+    return __stop_words
+
+
+def _clean_rows(df, newspapper_uid, engine='default', workers=None, memo=None):
+    steps = ENGINES[engine]
+    df = _timed_step('add_newspapper_uid_column', _add_newspapper_uid_column, df, newspapper_uid)
+    df = _timed_step('extract_host', steps['extract_host'], df)
+    df = _timed_step('fill_missing_titles', steps['fill_missing_titles'], df)
+    df = _timed_step('generate_uid_for_rows', steps['generate_uid_for_rows'], df)
 
     replacements = {
         "\n": " ",
         "\r": " ",
     }
-    df = _remove_unwanted_chars(df, replacements)
+    df = _timed_step('remove_unwanted_chars', steps['remove_unwanted_chars'], df, replacements)
+
+    if workers and workers > 1:
+        tokenize, args = _tokenize_columns_parallel, (workers,)
+    else:
+        tokenize, args = steps['tokenize_columns'], (_stop_words(),)
+    if memo:
+        tokenize, args = _tokenize_columns_memoized, (memo, tokenize) + args
+    df = _timed_step('tokenize_columns', tokenize, df, ['title_csv', 'body_csv'], *args)
+    return df
+
+
+def transform(df, newspapper_uid, engine='default', workers=None, memo=None):
+    df = _clean_rows(df, newspapper_uid, engine, workers, memo)
+    df = _timed_step('remove_duplicate_entries', _remove_duplicate_entries, df, 'title_csv')
+    df = _timed_step('drop_rows_with_missing_values', _drop_rows_with_missing_values, df)
+    return df
+
+
+def _read_data_chunks(filename, chunk_size):
+    _log('Reading file {} in chunks of {} rows'.format(filename, chunk_size))
+    import pandas as pd
+    return pd.read_csv(filename, chunksize=chunk_size)
 
-    stop_words = set(stopwords.words('spanish'))
-    df = _tokenize_columns(df, ['title_csv', 'body_csv'], stop_words)
-    df = _remove_duplicate_entries(df, 'title_csv')
-    df = _drop_rows_with_missing_values(df)
+
+def _hash_key(value):
+    # Titles are strings or NaN, NaN being the only value not equal to itself
+    if value is None or value != value:
+        return None
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _remove_seen_entries(df, column_name, seen):
+    # Keeps the first row of every value across calls, like drop_duplicates
+    # does for a whole frame, remembering 8 byte hashes instead of values
+    _log('Removing Duplicate Entries')
+    keep = []
+    for key in map(_hash_key, df[column_name]):
+        keep.append(key not in seen)
+        seen.add(key)
+    return df[keep]
+
+
+def _flag_near_duplicates(df, index, mode):
+    _log('Looking for near duplicate articles')
+    stop_words = _stop_words()
+    # Articles checked in an earlier run keep their answer, untokenized
+    known = index.known(df.index)
+    matches = [index.check(uid, newspapper_uid,
+                           None if uid in known else list(_valid_tokens(body, stop_words)))
+               for uid, newspapper_uid, body
+               in zip(df.index, df['newspapper_uid'], df['body_csv'])]
+    index.commit()
+    if mode == 'drop':
+        return df[[match is None for match in matches]]
+    df['near_duplicate_of'] = [match or '' for match in matches]
+    return df
+
+
+def _stream(filename, chunk_size, engine='default', workers=None,
+            near_duplicates=None, near_duplicates_mode='flag', memo=None):
+    newspapper_uid = _extract_newspapper_uid(filename)
+    clean_filename = 'clean_{}'.format(_remove_system_path(filename))
+    if os.path.exists(clean_filename):
+        os.remove(clean_filename)
+
+    seen_titles = set()
+    total_rows = 0
+    for chunk in _read_data_chunks(filename, chunk_size):
+        chunk = _clean_rows(chunk, newspapper_uid, engine, workers, memo)
+        chunk = _timed_step('remove_duplicate_entries', _remove_seen_entries,
+                            chunk, 'title_csv', seen_titles)
+        chunk = _timed_step('drop_rows_with_missing_values', _drop_rows_with_missing_values,
+                            chunk)
+        # Chunks with missing values would otherwise write counts as floats
+        chunk = chunk.astype({'n_token_title_csv': 'int64', 'n_token_body_csv': 'int64'})
+        if near_duplicates:
+            chunk = _timed_step('flag_near_duplicates', _flag_near_duplicates,
+                                chunk, near_duplicates, near_duplicates_mode)
+        _append_data(chunk, clean_filename)
+        total_rows += len(chunk)
+    return total_rows
+
+
+def report_memo(memo):
+    _log('Token counts memoized: {} hits, {} misses, {} evicted'.format(
+        memo.stats['hits'], memo.stats['misses'], memo.stats['evicted']))
+
+
+def main(filename, engine='default', workers=None, chunk_size=None,
+         near_duplicates_mode=None, similarity=0.8, use_memo=True):
+    _log('Starting cleaning process')
+    near_duplicates = None
+    if near_duplicates_mode:
+        near_duplicates = NearDuplicateIndex(threshold=similarity)
+    memo = TokenMemo() if use_memo else None
+
+    try:
+        if chunk_size:
+            total_rows = _stream(filename, chunk_size, engine, workers,
+                                 near_duplicates, near_duplicates_mode, memo)
+            print('Clean rows written: {}'.format(total_rows))
+            return total_rows
+
+        df = _read_data(filename, 'utf-8')
+        newspapper_uid = _extract_newspapper_uid(filename)
+        df = transform(df, newspapper_uid, engine, workers, memo)
+        if near_duplicates:
+            df = _timed_step('flag_near_duplicates', _flag_near_duplicates,
+                             df, near_duplicates, near_duplicates_mode)
+    finally:
+        shutdown_tokenizer_pool()
+        _report_steps()
+        metrics.export()
+        if near_duplicates:
+            _log('Near duplicates found: {} of {} articles'.format(
+                near_duplicates.stats['duplicates'], near_duplicates.stats['checked']))
+            near_duplicates.close()
+        if memo:
+            report_memo(memo)
+            memo.close()
     _save_data(df, filename)
 
     print(df[['title_csv', 'n_token_title_csv', 'n_token_body_csv']])
@@ -152,5 +505,50 @@ def main(filename):
 
 
 if __name__ == '__main__':
-    args = _get_args('filename', 'The parth to the dirty data', str)
-    main(args.filename)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename',
+                        help='The parth to the dirty data',
+                        type=str)
+    parser.add_argument('-e',
+                        '--engine',
+                        help='The implementation of the cleaning steps',
+                        choices=list(ENGINES.keys()),
+                        default='default')
+    parser.add_argument('-w',
+                        '--workers',
+                        help='Tokenize in a pool of this many processes',
+                        type=int,
+                        default=None)
+    parser.add_argument('-c',
+                        '--chunk-size',
+                        help='Stream the file in chunks of this many rows',
+                        type=int,
+                        default=None)
+    parser.add_argument('-d',
+                        '--near-duplicates',
+                        help='Flag articles similar to earlier ones, or drop them',
+                        choices=near_duplicates_modes,
+                        default=None)
+    parser.add_argument('-s',
+                        '--similarity',
+                        help='Estimated Jaccard similarity of near duplicate bodies',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--no-memo',
+                        help='Tokenize every text, even the ones counted in earlier runs',
+                        action='store_true')
+    parser.add_argument('--metrics-file',
+                        help='Write the metrics here, as JSON if it ends in .json',
+                        default=None)
+    parser.add_argument('--trace-file',
+                        help='Append the spans of every step here, one JSON per line',
+                        default=None)
+    args = parser.parse_args()
+    metrics.configure(args.metrics_file, args.trace_file)
+    main(args.filename,
+         args.engine,
+         args.workers,
+         args.chunk_size,
+         args.near_duplicates,
+         args.similarity,
+         not args.no_memo)
